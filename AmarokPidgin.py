@@ -2,20 +2,58 @@
 # Keegan Carruthers-Smith 2006-2010 <keegan.csmith@gmail.com>
 # Distributed under the GPLv2
 
+from time import sleep, time
+MODULE_STARTED = time()
+
+# Amarok starts AmarokPidgin when it starts, so modules only some features
+# need are imported where they are used.
 import dbus
+import fcntl
+import os
 import re
+import select
 import signal
-import xml.parsers.expat
+import sys
 from commands import getoutput, getstatusoutput
 from sys import stdin, exit, argv
-from time import sleep
+from threading import Thread, Lock, RLock, Condition, currentThread
 from ConfigParser import ConfigParser
 from StringIO import StringIO
-from Queue import Queue
-from random import choice
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 DEBUG = False
 
+CONFIG_FILE = "AmarokPidgin.ini"
+
+# Version of the messages MPRISPidgin.py sends
+PROTOCOL_VERSION = 1
+
+# Events which replace any earlier one which hasn't been handled yet
+STATE_EVENTS = ('playing', 'stopped')
+
+# Minimum number of seconds between checks for changes to CONFIG_FILE
+CONFIG_CHECK_INTERVAL = 2
+
+# Minimum rotate_interval, so IM servers aren't flooded with status changes
+MIN_ROTATE_INTERVAL = 30
+
+PURPLE_SERVICE = "im.pidgin.purple.PurpleService"
+
+# Seconds to wait before reconnecting to Pidgin, doubled after each failed
+# attempt. Pidgin's service appearing on the bus cuts the wait short.
+MIN_RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 20
+
+# Where Metrics writes its report
+METRICS_FILE = "/tmp/AmarokPidgin.metrics"
+
+ICON_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                             os.path.expanduser('~/.cache')),
+                              'AmarokPidgin', 'icons')
+
 DEFAULT_CONFIG = """
 [AmarokPidgin]
 status_name = Media
@@ -23,151 +61,1982 @@ status_message = Listening to $title by $artist on $album [Amarok]
 cover_icon = false
 censor = false
 censor_words = # Put words here separated by a | eg: word1|word2|word3
-display = status # Where to display song playing. either status or nick
+display = status # Where to display song playing: status, nick, file:PATH or socket:PATH. Separate several with commas, and add @SECONDS to one to limit how often it is updated
+coalesce_window = 0.3 # Seconds to wait for more events before updating Pidgin
+min_update_interval = 1 # Minimum seconds between updates to Pidgin
+async_updates = true # Update Pidgin from a background thread
+icon_cache_size = 5 # Megabytes of album covers scaled to buddy icon size to keep
+rotate_interval = 0 # Seconds between showing the next lyrics line or rotate_messages. 0 disables
+rotate_messages = # Other status messages to cycle through, separated by a |
 variable_map = # Put a lambda statement here that will be passed every (variable,value).
 variable_imports = # Put import statements here for any modules that may be needed to run variable_map
+variable_map_budget = 0.05 # Seconds variable_map may take for each variable
+history_file = # SQLite database to log played tracks to, eg ~/.AmarokPidgin.db. Empty disables
 """
 
-class ParseLyrics(object):
+class Waker(object):
+    """
+    Wakes the event loop from another thread, eg when a cover has been
+    scaled. While listening, the loop selects on fd as well as stdin, and
+    wake makes fd readable. Under a glib main loop on_wake is called instead.
+    """
+    def __init__(self):
+        self.fd, self.write_fd = os.pipe()
+        for fd in (self.fd, self.write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.on_wake = None
+
+    def wake(self):
+        on_wake = self.on_wake
+        if on_wake is not None:
+            on_wake()
+            return
+        try:
+            os.write(self.write_fd, 'x')
+        except OSError:
+            pass # The pipe is full, so a wakeup is already pending
+
+    def clear(self):
+        "Empties fd. Called by the event loop before it looks for work."
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError:
+            pass
+
+# Woken by the sinks' and the IconCache's threads
+main_waker = Waker()
+
+
+class LineReader(object):
+    """
+    Reads lines from a file descriptor with an optional timeout. Data is
+    buffered here rather than in a file object, so select never misses a line
+    that has already been read. The wait is cut short by waker, if given.
+    """
+    def __init__(self, fd, waker=None):
+        self.fd     = fd
+        self.waker  = waker
+        self.buffer = ''
+        self.eof    = False
+
+    def readline(self, timeout=None):
+        """
+        Returns the next line, '' at end of file or None if no line arrived
+        within timeout seconds, a signal interrupted the wait or the waker
+        was woken.
+        """
+        if timeout is not None:
+            deadline = time() + timeout
+
+        fds = [self.fd]
+        if self.waker is not None:
+            fds.append(self.waker.fd)
+
+        while '\n' not in self.buffer and not self.eof:
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, deadline - time())
+            try:
+                ready = wait_readable(fds, remaining)
+            except select.error:
+                return None # Interrupted by a signal, for the caller to handle
+            if self.fd not in ready:
+                return None
+
+            data = os.read(self.fd, 4096)
+            if not data:
+                self.eof = True
+            self.buffer += data
+
+        if '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            return line + '\n'
+        line, self.buffer = self.buffer, ''
+        return line
+
+# chardet is only imported when a string isn't UTF-8
+chardet_module = None
+
+def get_chardet():
+    "Returns the chardet module, or False if it is not installed."
+    global chardet_module
+    if chardet_module is None:
+        try:
+            import chardet
+            chardet_module = chardet
+        except ImportError:
+            chardet_module = False
+    return chardet_module
+
+
+class LRUCache(object):
+    """
+    Dictionary which holds at most size items. When full, the least recently
+    used item is dropped.
+    """
+    def __init__(self, size):
+        self.size  = size
+        self.items = {}
+        self.order = [] # Least recently used first
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.items[key]
+        self.order.remove(key)
+        self.order.append(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            self.order.remove(key)
+        elif len(self.order) >= self.size:
+            del self.items[self.order.pop(0)]
+        self.items[key] = value
+        self.order.append(key)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Metrics(object):
+    """
+    Counters and per-stage latency histograms, for finding out where the
+    time goes. Nothing is collected until SIGUSR1 switches collection on,
+    and while it is off timing a stage costs one attribute check. SIGUSR2,
+    or switching collection off again, writes a JSON report to
+    METRICS_FILE.
+
+    Latencies are counted in power of two millisecond buckets, so the
+    percentiles reported are upper bounds.
+    """
+    buckets = 16 # Bucket i holds latencies under 2**i ms, the last the rest
+
+    def __init__(self):
+        self.enabled    = False
+        self.lock       = Lock() # Stages are also timed by the Sinks
+        self.marks      = {} # Seconds from the process starting to each stage
+        self.requests   = [] # Signals not yet handled
+        self.on_request = None
+        self.reset()
+
+    def reset(self):
+        self.started  = time()
+        self.counters = {}
+        self.stages   = {} # name -> [count, total, max, bucket counts]
+
+    def request(self, signum, frame):
+        """
+        Signal handler for SIGUSR1 (toggle) and SIGUSR2 (dump). The signal
+        may arrive while lock is held, so the work is left to
+        handle_requests, which the event loop calls. on_request, if set, is
+        called to wake the event loop.
+        """
+        self.requests.append(signum)
+        if self.on_request is not None:
+            self.on_request()
+
+    def handle_requests(self):
+        "Carries out the toggles and dumps asked for by signals."
+        while self.requests:
+            if self.requests.pop(0) == signal.SIGUSR1:
+                self.toggle()
+            else:
+                self.dump()
+
+    def toggle(self):
+        "Switches collection on or off, writing the report when switched off."
+        if self.enabled:
+            self.enabled = False
+            self.dump()
+        else:
+            self.reset()
+            self.enabled = True
+
+    def mark(self, name):
+        """
+        Records how long after the process started name was first reached.
+        Always recorded, since it only happens once.
+        """
+        if name not in self.marks:
+            self.marks[name] = time() - process_started()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.lock.release()
+
+    def timed(self, name, func, *args):
+        "Returns func(*args), recording how long it took as stage name."
+        if not self.enabled:
+            return func(*args)
+        start = time()
+        try:
+            return func(*args)
+        finally:
+            self.record(name, time() - start)
+
+    def record(self, name, seconds):
+        ms = seconds * 1000
+        bucket = 0
+        while bucket < self.buckets - 1 and ms >= 2 ** bucket:
+            bucket += 1
+
+        self.lock.acquire()
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = [0, 0.0, 0.0, [0] * self.buckets]
+        stage[0] += 1
+        stage[1] += ms
+        stage[2] = max(stage[2], ms)
+        stage[3][bucket] += 1
+        self.lock.release()
+
+    def percentile(self, counts, total, fraction):
+        "Returns the upper bound in ms of the bucket holding the percentile."
+        seen = 0
+        for bucket, count in enumerate(counts):
+            seen += count
+            if seen >= total * fraction:
+                break
+        return 2 ** bucket
+
+    def report(self):
+        "Returns the metrics collected since collection was switched on."
+        self.lock.acquire()
+        try:
+            stages = {}
+            for name, (count, total, worst, counts) in self.stages.items():
+                stages[name] = {'count': count,
+                                'mean_ms': total / count,
+                                'max_ms': worst,
+                                'p50_ms': self.percentile(counts, count, 0.5),
+                                'p90_ms': self.percentile(counts, count, 0.9),
+                                'p99_ms': self.percentile(counts, count, 0.99),
+                                'buckets': counts[:]}
+            report = {'seconds': time() - self.started,
+                      'counters': dict(self.counters),
+                      'stages': stages,
+                      'startup': dict(self.marks)}
+        finally:
+            self.lock.release()
+
+        events = report['counters'].get('events')
+        if events:
+            calls = report['counters'].get('dbus_calls', 0)
+            report['dbus_calls_per_event'] = float(calls) / events
+        return report
+
+    def dump(self):
+        "Writes the report to METRICS_FILE."
+        try:
+            out = file(METRICS_FILE, "w")
+            try:
+                json.dump(self.report(), out, indent=2, sort_keys=True)
+            finally:
+                out.close()
+        except IOError:
+            pass
+
+
+metrics = Metrics()
+
+
+# When the process started, which is looked up once
+process_start_time = None
+
+def process_started():
+    """
+    Returns when this process was started, so the interpreter's own startup
+    is counted too. This is read from /proc, and elsewhere it is when this
+    module started loading.
+    """
+    global process_start_time
+    if process_start_time is None:
+        process_start_time = MODULE_STARTED
+        try:
+            stat = file('/proc/self/stat').read()
+            ticks = float(stat[stat.rindex(')') + 2:].split()[19])
+            uptime = float(file('/proc/uptime').read().split()[0])
+            process_start_time = time() - uptime + \
+                                 ticks / os.sysconf('SC_CLK_TCK')
+        except (IOError, OSError, ValueError, IndexError):
+            pass
+    return process_start_time
+
+
+class CountedInterface(object):
+    "Wraps a D-Bus interface, counting the calls made through it in metrics."
+    def __init__(self, interface):
+        self.interface = interface
+
+    def __getattr__(self, name):
+        method = getattr(self.interface, name)
+        if not metrics.enabled:
+            return method
+
+        def call(*args, **kwargs):
+            metrics.count('dbus_calls')
+            return method(*args, **kwargs)
+        return call
+
+
+class EventReader(LineReader):
+    """
+    Reads events from lines. If the reader has fallen behind, a playing or
+    stopped event is dropped when a later one is already waiting, since only
+    the latest state matters.
+    """
+    def __init__(self, fd, waker=None):
+        LineReader.__init__(self, fd, waker)
+        self.pushback = None # An event read while looking for later ones
+        self.dropped  = 0
+
+    def read_event(self, parse, timeout=None):
+        """
+        Returns the next event, or None if there was none within timeout
+        seconds. parse turns a line into an event, or None if the line isn't
+        one. 'quit' is returned at end of file.
+        """
+        if self.pushback is not None:
+            event, self.pushback = self.pushback, None
+        else:
+            event = self.read_one(parse, timeout)
+
+        # Skip to the latest state if more events are waiting
+        while event in STATE_EVENTS:
+            line = self.readline(0)
+            if not line: # Nothing waiting, or end of file
+                break
+            later = parse(line)
+            if later in STATE_EVENTS:
+                self.dropped += 1
+                metrics.count('dropped')
+                event = later
+            elif later is not None:
+                self.pushback = later
+                break
+
+        return event
+
+    def read_one(self, parse, timeout):
+        if timeout is not None:
+            deadline = time() + timeout
+
+        while True:
+            if timeout is not None:
+                timeout = max(0, deadline - time())
+            line = self.readline(timeout)
+
+            if line is None:
+                return None
+            if len(line) == 0:
+                return 'quit'
+
+            event = parse(line)
+            if event is not None:
+                return event
+
+# Shared by the engines, so buffered input survives reconnecting to Pidgin
+stdin_lines = EventReader(stdin.fileno(), main_waker)
+
+
+# The glib main context D-Bus signals are dispatched from, if available
+main_context = None
+
+# Whether a glib main loop is running, in which case it dispatches signals
+main_loop_running = False
+
+# The thread the event loop runs in, the only one which dispatches signals
+main_thread = currentThread()
+
+def init_mainloop():
+    """
+    Makes glib the default D-Bus main loop so that signals can be received.
+    Needs to be called before the first bus connection is made. Returns
+    False if python-gobject is not installed.
+    """
+    global main_context
+    try:
+        import gobject
+        import dbus.mainloop.glib
+    except ImportError:
+        return False
+
+    gobject.threads_init()
+    dbus.mainloop.glib.threads_init()
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    main_context = gobject.main_context_default()
+    return True
+
+def wait_for_pidgin(timeout):
+    """
+    Waits until Pidgin's D-Bus service gets a new owner, or timeout seconds
+    have passed. Without a glib main context the signal can't be received,
+    so this just sleeps.
+    """
+    if main_context is None:
+        sleep(timeout)
+        return
+
+    import gobject
+    appeared = []
+    try:
+        match = dbus.SessionBus().add_signal_receiver(
+            lambda name, old_owner, new_owner: new_owner and appeared.append(1),
+            'NameOwnerChanged', 'org.freedesktop.DBus', arg0=PURPLE_SERVICE)
+    except dbus.DBusException:
+        sleep(timeout)
+        return
+
+    expired = []
+    timer = gobject.timeout_add(int(timeout * 1000),
+                                lambda: expired.append(True))
+    try:
+        while not appeared and not expired:
+            main_context.iteration(True)
+    finally:
+        match.remove()
+        if not expired:
+            gobject.source_remove(timer)
+
+def wait_readable(fds, timeout):
+    """
+    Returns those of fds which are readable, waiting up to timeout seconds
+    for one to be. With a glib main context, D-Bus signals are dispatched
+    while waiting, so one which wakes main_waker cuts the wait short.
+    """
+    if main_context is None or main_loop_running or \
+           currentThread() is not main_thread:
+        return select.select(fds, [], [], timeout)[0]
+
+    import gobject
+    ready = []
+    watches = {}
+    for fd in fds:
+        watches[fd] = gobject.io_add_watch(
+            fd, gobject.IO_IN | gobject.IO_HUP | gobject.IO_ERR,
+            lambda fd, condition: ready.append(fd))
+    expired = []
+    timer = None
+    if timeout is not None:
+        timer = gobject.timeout_add(int(timeout * 1000),
+                                    lambda: expired.append(True))
+    try:
+        while not ready and not expired:
+            main_context.iteration(True)
+    finally:
+        if timer is not None and not expired:
+            gobject.source_remove(timer)
+        for fd, watch in watches.items():
+            if fd not in ready:
+                gobject.source_remove(watch)
+    return ready
+
+def pump_events():
+    """
+    Dispatches any D-Bus signals which have arrived, without blocking. Does
+    nothing outside the main thread, so handlers never run in a sink's.
+    """
+    if main_context is not None and not main_loop_running and \
+           currentThread() is main_thread:
+        while main_context.pending():
+            main_context.iteration(False)
+
+
+def parse_targets(text):
+    """
+    Parses the display setting: a comma separated list of status, nick,
+    file:PATH and socket:PATH, each of which may be followed by @SECONDS,
+    the least time between updates to it. Returns (kind, path,
+    min_interval) tuples, in the order given.
+    """
+    targets = []
+    for spec in text.split('#')[0].split(','):
+        interval = 0.0
+        if '@' in spec:
+            spec, interval = spec.rsplit('@', 1)
+            try:
+                interval = float(interval)
+            except ValueError:
+                interval = 0.0
+
+        kind, path = (spec.split(':', 1) + [''])[:2]
+        kind, path = kind.strip(), path.strip()
+        if kind in ('status', 'nick'):
+            targets.append((kind, '', interval))
+        elif kind in ('file', 'socket') and path:
+            targets.append((kind, os.path.expanduser(path), interval))
+
+    if not targets:
+        targets.append(('status', '', 0.0))
+    return tuple(targets)
+
+
+class Sink(Thread):
+    """
+    Somewhere the Now Playing message is shown. Each sink is updated from its
+    own thread, so a slow sink never holds up the others, and adding sinks
+    doesn't add to how long a track change takes to show. Only the latest
+    update given to a sink is applied, at most once every min_interval
+    seconds, and not at all if it is what the sink already shows.
+
+    Subclasses implement show(value) and clear(), which is called for an
+    update of None. An exception raised by either is kept, the event loop is
+    woken, and it is re-raised in the main thread by check().
+    """
+    skip_unchanged = True
+
+    def __init__(self, label, min_interval=0):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.label        = label
+        self.min_interval = min_interval
+        self.condition    = Condition()
+        self.pending      = None # (value,) of the latest update not applied
+        self.shown        = None # (value,) of the last update applied
+        self.last         = 0    # When the last update was applied
+        self.running      = False
+        self.stopped      = False
+        self.error        = None
+
+    def update(self, value):
+        "Queues value to be shown, replacing any update not yet applied."
+        self.condition.acquire()
+        try:
+            self.pending = (value,)
+            self.condition.notify()
+            if not self.running:
+                self.running = True
+                self.start()
+        finally:
+            self.condition.release()
+
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while not self.stopped:
+                    wait = self.last + self.min_interval - time()
+                    if self.pending is not None and wait <= 0:
+                        break
+                    if self.pending is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(wait)
+                if self.stopped:
+                    return
+                value, self.pending = self.pending[0], None
+            finally:
+                self.condition.release()
+
+            try:
+                self.apply(value)
+            except:
+                self.error = sys.exc_info()
+                main_waker.wake() # So check() raises it without waiting
+                return
+
+    def apply(self, value):
+        "Shows value in this thread, or clears the sink if it is None."
+        if self.skip_unchanged and self.shown == (value,):
+            return
+        if value is None:
+            self.clear()
+        else:
+            metrics.timed(self.label, self.show, value)
+            metrics.mark('first_update')
+        self.shown = (value,)
+        self.last = time()
+
+    def check(self):
+        "Re-raises the exception from a failed update, if any."
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+    def stop(self):
+        "Stops the thread. Updates not yet applied are dropped."
+        self.condition.acquire()
+        self.stopped = True
+        self.condition.notify()
+        self.condition.release()
+
+
+class PidginSink(Sink):
+    """
+    A sink shown by functions which update Pidgin. The Pidgin sinks share
+    lock, the PurpleState's, so only one of them updates Pidgin at a time.
+    """
+    def __init__(self, label, show, clear, lock, min_interval=0,
+                 skip_unchanged=True):
+        Sink.__init__(self, label, min_interval)
+        self.show           = show
+        self.clear          = clear
+        self.lock           = lock
+        self.skip_unchanged = skip_unchanged
+
+    def apply(self, value):
+        self.lock.acquire()
+        try:
+            if not self.stopped: # Pidgin may have been restored meanwhile
+                Sink.apply(self, value)
+        finally:
+            self.lock.release()
+
+
+class FileSink(Sink):
+    "Writes the message to a file, eg for a shell prompt to show."
+    def __init__(self, path, min_interval=0):
+        Sink.__init__(self, 'file', min_interval)
+        self.path = path
+
+    def show(self, message):
+        # Written to a temporary file first, so readers never see half of it
+        tmp = self.path + '.tmp'
+        try:
+            out = file(tmp, 'w')
+            if message:
+                out.write(message.encode('utf8') + '\n')
+            out.close()
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass # Nothing else depends on the file
+
+    def clear(self):
+        self.show(u'')
+
+
+class SocketSink(Sink):
+    """
+    Sends the message as a datagram to a UNIX socket, eg one a status bar
+    listens on. Messages are dropped while nothing is listening.
+    """
+    def __init__(self, path, min_interval=0):
+        import socket
+        Sink.__init__(self, 'socket', min_interval)
+        self.path   = path
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def show(self, message):
+        import socket
+        try:
+            self.socket.sendto(message.encode('utf8'), self.path)
+        except socket.error:
+            pass
+
+    def clear(self):
+        self.show(u'')
+
+
+class IconCache(Thread):
+    """
+    Album covers scaled down to buddy icon size, so Pidgin never has to load
+    a full size cover. An icon is named by a hash of its cover's path and
+    mtime, so a changed cover gets a new icon. Covers are scaled in this
+    thread, and when the cache holds more than max_bytes the least recently
+    used icons are removed.
+
+    Scaling uses PIL if it is installed, otherwise ImageMagick's convert.
+    """
+    size = 96 # The largest icon most protocols accept
+
+    def __init__(self, directory, max_bytes, on_ready):
+        from Queue import Queue
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.on_ready  = on_ready
+        self.covers    = Queue()
+        self.pending   = set()
+        self.scaler    = None
+        self.started   = False
+
+    def icon_path(self, cover):
+        "Returns where the icon for cover is cached."
+        try:
+            from hashlib import sha1
+        except ImportError:
+            from sha import new as sha1
+        key = '%s:%r' % (cover, os.stat(cover).st_mtime)
+        return os.path.join(self.directory, sha1(key).hexdigest() + '.png')
+
+    def get(self, cover):
+        """
+        Returns the icon for cover. If it isn't cached yet it is queued for
+        scaling, on_ready(cover) is called from this thread once it is done
+        and None is returned. If covers can't be scaled, cover itself is
+        returned.
+        """
+        if self.get_scaler() is False:
+            return cover
+
+        try:
+            path = self.icon_path(cover)
+        except OSError:
+            return cover
+        if os.path.exists(path):
+            os.utime(path, None) # Mark as recently used
+            return path
+
+        if cover not in self.pending:
+            self.pending.add(cover)
+            self.covers.put(cover)
+            if not self.started:
+                self.started = True
+                self.start()
+        return None
+
+    def get_scaler(self):
+        "Returns the function used to scale covers, or False if there is none."
+        if self.scaler is None:
+            try:
+                import Image
+                def scale(cover, path):
+                    image = Image.open(cover)
+                    image.thumbnail((self.size, self.size), Image.ANTIALIAS)
+                    image.save(path, 'PNG')
+            except ImportError:
+                import subprocess
+                def scale(cover, path):
+                    size = '%dx%d' % (self.size, self.size)
+                    args = ['convert', cover, '-thumbnail', size, 'png:' + path]
+                    if subprocess.call(args) != 0:
+                        raise IOError('convert failed on %r' % cover)
+                if getstatusoutput('convert -version')[0] != 0:
+                    scale = False
+            self.scaler = scale
+        return self.scaler
+
+    def run(self):
+        while True:
+            cover = self.covers.get()
+            try:
+                self.scale(cover)
+                self.on_ready(cover)
+            except:
+                pass # The cover will be used unscaled, and others still scaled
+            self.pending.discard(cover)
+
+    def scale(self, cover):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        path = self.icon_path(cover)
+        tmp = path + '.tmp'
+        self.get_scaler()(cover, tmp)
+        os.rename(tmp, path)
+
+        self.evict()
+
+    def evict(self):
+        "Removes the least recently used icons until under max_bytes."
+        icons = []
+        total = 0
+        for name in os.listdir(self.directory):
+            st = os.stat(os.path.join(self.directory, name))
+            icons.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        icons.sort()
+        while total > self.max_bytes and icons:
+            mtime, size, name = icons.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+
+class PlayHistory(Thread):
+    """
+    A log of the tracks played, kept in an SQLite database. Plays are
+    written by this thread in batches, so the event handlers never wait on
+    the disk. The database is in WAL mode, so queries made from the main
+    thread don't hold up the writer.
+
+    As well as the plays, how often each track was played is kept up to date
+    when a play is written, so recent and top only read an index.
+    """
+    batch_delay = 5 # Seconds to wait for more plays before writing a batch
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS plays (started REAL, artist TEXT, "
+        "album TEXT, title TEXT, played REAL)",
+        "CREATE INDEX IF NOT EXISTS plays_started ON plays (started)",
+        "CREATE TABLE IF NOT EXISTS tracks (artist TEXT, title TEXT, "
+        "plays INTEGER, last REAL, PRIMARY KEY (artist, title))",
+        "CREATE INDEX IF NOT EXISTS tracks_plays ON tracks (plays)",
+    )
+
+    def __init__(self, path):
+        from Queue import Queue
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.path   = path
+        self.plays  = Queue()
+        self.latest  = None # The last play added, which may not be written yet
+        self.reader  = None # Connection for queries from the main thread
+        self.started = False
+        self.error   = None # Why the database can't be used, if it can't
+
+    def connect(self):
+        import sqlite3
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for statement in PlayHistory.schema:
+            db.execute(statement)
+        db.commit()
+        return db
+
+    def open(self):
+        """
+        Opens the database for queries, creating it if needed. Returns False,
+        with the reason in error, if it can't be used.
+        """
+        import sqlite3
+        try:
+            self.reader = self.connect()
+        except sqlite3.Error, e:
+            self.error = str(e)
+            return False
+        return True
+
+    def add(self, started, artist, album, title, played):
+        """
+        Queues a play to be written. started is when the track started, and
+        played how many seconds of it were played. The strings are unicode.
+        Nothing is done once the database has failed.
+        """
+        if self.error is not None:
+            return
+        self.latest = (started, artist, album, title, played)
+        self.plays.put(self.latest)
+        if not self.started:
+            self.started = True
+            self.start()
+
+    def stop(self):
+        "Writes any queued plays and stops the thread."
+        if self.isAlive():
+            self.plays.put(None)
+            self.join(10)
+
+    def run(self):
+        from Queue import Empty
+        import sqlite3
+        try:
+            db = self.connect()
+        except sqlite3.Error, e:
+            self.error = str(e)
+            return
+
+        while True:
+            batch = [self.plays.get()]
+            deadline = time() + PlayHistory.batch_delay
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.plays.get(True,
+                                                max(0, deadline - time())))
+                except Empty:
+                    break
+
+            try:
+                self.write(db, [play for play in batch if play is not None])
+            except:
+                db.rollback() # The batch is lost, but the history carries on
+            if batch[-1] is None:
+                break
+        db.close()
+
+    def write(self, db, plays):
+        db.executemany("INSERT INTO plays VALUES (?, ?, ?, ?, ?)", plays)
+        for started, artist, album, title, played in plays:
+            cursor = db.execute("UPDATE tracks SET plays = plays + 1, last = ? "
+                                "WHERE artist = ? AND title = ?",
+                                (started, artist, title))
+            if cursor.rowcount == 0:
+                db.execute("INSERT INTO tracks VALUES (?, ?, 1, ?)",
+                           (artist, title, started))
+        db.commit()
+
+    def query(self, sql, args):
+        "Returns the rows for sql, or no rows if the database has failed."
+        import sqlite3
+        if self.error is not None or (self.reader is None and not self.open()):
+            return []
+        try:
+            return self.reader.execute(sql, args).fetchall()
+        except sqlite3.Error, e:
+            self.error = str(e)
+            return []
+
+    def recent(self, count):
+        """
+        Returns the count most recent plays written, newest first, as
+        (started, artist, album, title, played) tuples.
+        """
+        return self.query("SELECT started, artist, album, title, played "
+                          "FROM plays ORDER BY started DESC LIMIT ?", (count,))
+
+    def top(self, count):
+        "Returns the count most played tracks as (artist, title, plays) tuples."
+        return self.query("SELECT artist, title, plays FROM tracks "
+                          "ORDER BY plays DESC LIMIT ?", (count,))
+
+    def last(self):
+        "Returns the most recent play, including one not yet written, or None."
+        if self.latest is None:
+            plays = self.recent(1)
+            if plays:
+                self.latest = tuple(plays[0])
+        return self.latest
+
+
+class Lyrics(object):
+    """
+    A track's lyrics, parsed from Amarok's lyrics XML in a single pass. The
+    non-empty lines are joined into one string and the offset of each line
+    is kept, so any line can be fetched without parsing again.
+    """
+    __slots__ = ('page_url', 'text', 'offsets')
+
     def __init__(self, lyric_xml):
-        p = xml.parsers.expat.ParserCreate()
+        self.page_url = u''
+        chunks = []
+
+        def start_element(name, attrs):
+            if 'page_url' in attrs:
+                self.page_url = attrs['page_url']
+
+        if lyric_xml: # Most tracks have none, so expat is never needed
+            import xml.parsers.expat
+            p = xml.parsers.expat.ParserCreate()
+            p.StartElementHandler = start_element
+            p.CharacterDataHandler = chunks.append
+            try:
+                p.Parse(lyric_xml, True)
+            except xml.parsers.expat.ExpatError:
+                pass # Use what was parsed before the error
+
+        # Remove uneeded whitespace and empty lines
+        lines = [line.strip() for line in u''.join(chunks).split(u'\n')]
+        lines = [line for line in lines if line]
+
+        self.text = u'\n'.join(lines)
+        self.offsets = []
+        offset = 0
+        for line in lines:
+            self.offsets.append(offset)
+            offset += len(line) + 1
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line(self, index):
+        "Returns the line at index."
+        start = self.offsets[index]
+        if index + 1 < len(self.offsets):
+            return self.text[start:self.offsets[index + 1] - 1]
+        return self.text[start:]
+
+
+class Template(object):
+    """
+    A status message compiled into literal chunks and variable slots, so that
+    it is only scanned once when the config is loaded. Variables are matched
+    longest first, so $lyricsURL is never mistaken for $lyrics.
+    """
+    def __init__(self, text, variables):
+        names = sorted(variables, key=len, reverse=True)
+        pattern = re.compile(r'\$(%s)' % '|'.join(names))
+        if not isinstance(text, unicode):
+            text = text.decode('utf8', 'replace')
+
+        self.text   = text
+        self.chunks = [] # Literal text, with None where a variable goes
+        self.slots  = [] # (index into chunks, variable)
+
+        pos = 0
+        for match in pattern.finditer(text):
+            self.chunks.append(text[pos:match.start()])
+            self.slots.append((len(self.chunks), match.group(1)))
+            self.chunks.append(None)
+            pos = match.end()
+        self.chunks.append(text[pos:])
+
+        # The fields that need to be fetched to render the template
+        fields = []
+        for index, var in self.slots:
+            if var not in fields:
+                fields.append(var)
+        if "title" in fields and "nowPlaying" not in fields:
+            fields.append("nowPlaying") # Fallback for an empty title
+        self.fields = tuple(fields)
+
+    def render(self, values):
+        "Returns the template with each variable replaced by values[var]."
+        chunks = self.chunks[:]
+        for index, var in self.slots:
+            chunks[index] = values[var]
+        return ''.join(chunks)
+
+
+class Censor(object):
+    """
+    Replaces expletives in a message with asterisks. The expletives are a |
+    separated regular expression, compiled once per config load. If every
+    word is a plain word they are merged into a trie first, so that words
+    sharing a prefix share a branch of the regular expression instead of
+    being tried one after the other.
+    """
+    special = re.compile(r'[.^$*+?{}\[\]\\|()]')
+
+    def __init__(self, expletives):
+        words = [word for word in expletives.split('|') if word]
+        if [word for word in words if Censor.special.search(word)]:
+            pattern = expletives
+        else:
+            trie = {}
+            for word in words:
+                node = trie
+                for char in word.lower():
+                    node = node.setdefault(char, {})
+                node[''] = None
+            pattern = Censor.trie_pattern(trie)
+        self.censor_re = re.compile('(%s)' % pattern, re.IGNORECASE)
+
+    def trie_pattern(trie):
+        "Returns a regular expression matching every word in trie."
+        branches = []
+        for char in sorted(trie):
+            if char:
+                branches.append(re.escape(char) + Censor.trie_pattern(trie[char]))
+        if not branches:
+            return ''
+
+        if len(branches) == 1:
+            pattern = branches[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(branches)
+        if '' in trie: # A word ends here, but longer words carry on
+            pattern = '(?:%s)?' % pattern
+        return pattern
+    trie_pattern = staticmethod(trie_pattern)
+
+    def __call__(self, message):
+        "Returns the censored message."
+        return self.censor_re.sub(lambda m: '*' * len(m.group(0)), message)
+
+
+class Track(object):
+    """
+    Immutable record of a track's metadata. A Track is taken once per track
+    change with a single round trip to Amarok, and every variable and the
+    cover image are then looked up from it. Missing keys are empty strings.
+    """
+    __slots__ = ('_fields',)
+
+    def __init__(self, fields):
+        object.__setattr__(self, '_fields', dict(fields))
+
+    def __getitem__(self, key):
+        return self._fields.get(key, '')
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Track is immutable")
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def __eq__(self, other):
+        return isinstance(other, Track) and self._fields == other._fields
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Track(%r)' % self._fields
 
-        p.StartElementHandler = self.start_element
-        p.EndElementHandler = self.end_element
-        p.CharacterDataHandler = self.char_data
 
-        self.page_url = ''
-        self.lyrics = []
+class Amarok2(object):
+    """
+    Dictionary like interface to Amarok2's metadata. Uses Amaroks MPRIS DBUS
+    interface.
+    """
+    def __init__(self):
+        self.bus = dbus.SessionBus()
+        obj = self.bus.get_object('org.mpris.amarok', '/Player')
+        interface = 'org.freedesktop.MediaPlayer'
+        self.player = CountedInterface(dbus.Interface(obj,
+                                                      dbus_interface=interface))
+
+        # GetMetadata is fetched once per event, and invalidated by listen
+        self.metadata_cache = None
+        self.matches        = []
+
+    def metadata(self):
+        "Returns the metadata for the current event, fetching it if needed."
+        if self.metadata_cache is None:
+            metrics.count('metadata_cache_misses')
+            self.metadata_cache = self.player.GetMetadata()
+        else:
+            metrics.count('metadata_cache_hits')
+        return self.metadata_cache
+
+    def invalidate(self):
+        "Forgets the cached metadata. Called on every status or track change."
+        self.metadata_cache = None
+
+    def __getitem__(self, key):
+        if key == 'coverImage':
+            arturl = self.get('arturl')
+            if arturl.startswith('file://'):
+                return arturl[7:]
+        return self.get(key)
+
+    def get(self, key):
+        "Returns key from the metadata as a utf8 encoded string."
+        value = self.metadata().get(key, '')
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        return str(value)
+
+    def snapshot(self, keys):
+        "Returns a Track with the values of keys."
+        return Track([(key, self[key]) for key in keys])
+
+    def is_playing(self):
+        return self.player.GetStatus()[0] == 0
+
+    def listen(self):
+        "Generator that listens for messages from MPRISPidgin.py."
+        while True:
+            yield self.next_event()
+
+    def next_event(self, timeout=None):
+        """
+        Returns the next event from MPRISPidgin.py, or None if there was none
+        within timeout seconds.
+        """
+        event = stdin_lines.read_event(self.parse, timeout)
+        if event == 'quit':
+            exit(0)
+        return event
+
+    def parse(self, line):
+        """
+        Parses a message from MPRISPidgin.py. Each line is a JSON object with
+        the protocol version, event type, timestamp and a payload. The
+        payload of a playing event has the track's metadata, which replaces
+        the cached metadata so no D-Bus round trip is needed. Returns None
+        for a line which isn't such a message.
+
+        How long the message took to arrive is recorded as the delivery
+        stage.
+        """
+        try:
+            message = json.loads(line)
+            if message.get('v') != PROTOCOL_VERSION:
+                return None
+            event = message['type']
+            sent = float(message['ts'])
+            metadata = message['payload'].get('metadata')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+        if event not in ('playing', 'stopped', 'quit'):
+            return None
+
+        if metrics.enabled:
+            metrics.record('delivery', max(0, time() - sent))
+        self.invalidate()
+        if isinstance(metadata, dict):
+            self.metadata_cache = metadata
+        return event
+
+    def watch(self, callback):
+        """
+        Subscribes to Amarok's MPRIS signals, calling callback with each
+        event. Used instead of listen when running in a single process.
+        """
+        def status_changed(status, *args):
+            self.invalidate()
+            if status[0] == 0:
+                callback('playing')
+            else:
+                callback('stopped')
+
+        def track_changed(metadata, *args):
+            self.metadata_cache = metadata
+            callback('playing')
+
+        interface = 'org.freedesktop.MediaPlayer'
+        self.matches = [
+            self.bus.add_signal_receiver(status_changed, 'StatusChange',
+                                         interface),
+            self.bus.add_signal_receiver(track_changed, 'TrackChange',
+                                         interface)]
+
+    def unwatch(self):
+        for match in self.matches:
+            match.remove()
+        self.matches = []
+
+    def passive_popup(self, msg):
+        # TODO send passive msg to Amarok 2
+        pass
+
+
+class Amarok1(object):
+    """
+    Dictionary like interface to Amarok1's metadata. Uses Amaroks DCOP
+    interface.
+    """
+    # Keys which are served by a different DCOP call
+    dcop_calls = {"lyricsURL": "lyrics"} # URL is extracted from lyrics
+
+    # Printed between the output of each DCOP call in a snapshot
+    separator = "--AmarokPidgin-snapshot--"
+
+    def __getitem__(self, key):
+        return self.snapshot([key])[key]
+
+    def snapshot(self, keys):
+        """
+        Returns a Track with the values of keys. All the DCOP calls are run
+        from a single shell, instead of forking a shell for every key.
+        """
+        calls = []
+        for key in keys:
+            call = Amarok1.dcop_calls.get(key, key)
+            if call not in calls:
+                calls.append(call)
+        if not calls:
+            return Track({})
+
+        script = '; '.join(["dcop amarok player %s 2> /dev/null; echo %s"
+                            % (call, Amarok1.separator) for call in calls])
+        output = getoutput(script).split(Amarok1.separator)
+        results = dict(zip(calls, [value.strip() for value in output]))
+
+        fields = {}
+        for key in keys:
+            value = results.get(Amarok1.dcop_calls.get(key, key), '')
+            if key == 'coverImage' and 'nocover' in value:
+                value = ''
+            fields[key] = value
+
+        return Track(fields)
+
+    def is_playing(self):
+        return getoutput('dcop amarok player isPlaying 2> /dev/null').lower() == "true"
+
+    def listen(self):
+        """
+        Generator that listens for messages from stdin.
+        """
+        while True:
+            yield self.next_event()
+
+    def next_event(self, timeout=None):
+        """
+        Returns the next event from Amarok's notifications on stdin, or None
+        if there was none within timeout seconds.
+        """
+        event = stdin_lines.read_event(self.parse, timeout)
+        if event == 'quit':
+            exit(0)
+        return event
+
+    def parse(self, message):
+        "Returns the event for one of Amarok's notifications, or None."
+        # Function that given a list, will tell you if any of the
+        # strings are in message
+        is_in = lambda li: len([x for x in li if x in message]) > 0
+
+        if is_in( ("trackChange", "playing") ):
+            return 'playing'
+        elif is_in( ("empty", "idle", "paused") ):
+            return 'stopped'
+        elif "configure" in message:
+            return 'configure'
+        return None
+
+    def passive_popup(self, msg):
+        getoutput("dcop amarok playlist popupMessage '%s' 2> /dev/null" % msg)
+
+
+class MPRIS2(object):
+    """
+    Dictionary like interface to the metadata of any player supporting
+    MPRIS2. Players are discovered from NameOwnerChanged, and their metadata
+    is pushed by PropertiesChanged, so it never needs to be polled. Of the
+    players, the one which most recently started playing is followed.
+    Needs init_mainloop to have been called.
+    """
+    prefix     = 'org.mpris.MediaPlayer2.'
+    path       = '/org/mpris/MediaPlayer2'
+    interface  = 'org.mpris.MediaPlayer2.Player'
+    properties = 'org.freedesktop.DBus.Properties'
+
+    def __init__(self):
+        self.bus      = dbus.SessionBus()
+        self.players  = {} # bus name -> {'status': ..., 'metadata': ...}
+        self.owners   = {} # unique name -> bus name
+        self.active   = None # bus name of the player being followed
+        self.events   = [] # Events not yet returned by next_event
+        self.callback = None
+
+        self.matches = [
+            self.bus.add_signal_receiver(self.name_owner_changed,
+                                         'NameOwnerChanged',
+                                         'org.freedesktop.DBus'),
+            self.bus.add_signal_receiver(self.properties_changed,
+                                         'PropertiesChanged',
+                                         MPRIS2.properties, path=MPRIS2.path,
+                                         sender_keyword='sender')]
+
+        for name in self.bus.list_names():
+            if name.startswith(MPRIS2.prefix):
+                try:
+                    owner = self.bus.get_name_owner(name)
+                except dbus.DBusException:
+                    continue # The player has already gone
+                self.add_player(name, owner)
 
-        p.Parse(lyric_xml)
+    def add_player(self, name, owner):
+        """
+        Starts following the player owning name. If its properties can't be
+        fetched yet, eg while it is starting up, they are fetched when it
+        first sends PropertiesChanged.
+        """
+        self.owners[owner] = name
+        self.load_player(name)
 
-    def start_element(self, name, attrs):
-        if 'page_url' in attrs:
-            self.page_url = attrs['page_url']
+    def load_player(self, name):
+        "Fetches the player's properties. Returns False if that failed."
+        try:
+            obj = self.bus.get_object(name, MPRIS2.path)
+            props = CountedInterface(dbus.Interface(obj, MPRIS2.properties))
+            values = props.GetAll(MPRIS2.interface)
+        except dbus.DBusException:
+            return False
+        self.players[name] = {'status': values.get('PlaybackStatus', ''),
+                              'metadata': values.get('Metadata', {})}
+        if self.active is None or self.players[name]['status'] == 'Playing':
+            self.active = name
+        return True
+
+    def name_owner_changed(self, name, old_owner, new_owner):
+        if not name.startswith(MPRIS2.prefix):
+            return
 
-    def end_element(self, name):
-        # Normalize data
-        self.lyrics = ''.join(self.lyrics).split('\n')
-        # Remove uneeded whitespace
-        self.lyrics = [s.strip() for s in self.lyrics]
-        # Remove empty lines
-        self.lyrics = filter(bool, self.lyrics)
+        if old_owner:
+            self.owners.pop(old_owner, None)
+            self.players.pop(name, None)
+            if name == self.active:
+                self.active = None
+                self.emit('stopped')
+        if new_owner:
+            self.add_player(name, new_owner)
+            if name == self.active and self.is_playing():
+                self.emit('playing')
+
+    def properties_changed(self, interface, changed, invalidated, sender=None):
+        name = self.owners.get(sender)
+        if interface != MPRIS2.interface or name is None:
+            return
 
-    def char_data(self, data):
-        self.lyrics.append(data)
+        if 'Metadata' not in changed and 'PlaybackStatus' not in changed:
+            return # Eg the volume changed
+        if name not in self.players and not self.load_player(name):
+            return
 
+        player = self.players[name]
+        if 'Metadata' in changed:
+            player['metadata'] = changed['Metadata']
+        if 'PlaybackStatus' in changed:
+            player['status'] = changed['PlaybackStatus']
+
+        if player['status'] == 'Playing':
+            self.active = name
+            self.emit('playing')
+        elif name == self.active and 'PlaybackStatus' in changed:
+            self.emit('stopped')
+
+    def emit(self, event):
+        if self.callback is not None:
+            self.callback(event)
+        else:
+            self.events.append(event)
 
-class Amarok2(object):
-    """
-    Dictionary like interface to Amarok2's metadata. Uses Amaroks MPRIS DBUS
-    interface.
-    """
-    def __init__(self):
-        bus = dbus.SessionBus()
-        obj = bus.get_object('org.mpris.amarok', '/Player')
-        interface = 'org.freedesktop.MediaPlayer'
-        self.player = dbus.Interface(obj, dbus_interface=interface)
+    def metadata(self):
+        if self.active is None:
+            return {}
+        return self.players[self.active]['metadata']
 
     def __getitem__(self, key):
+        metadata = self.metadata()
+        get = lambda name: metadata.get(name, '')
+
         if key == 'coverImage':
-            arturl = str(self.player.GetMetadata().get('arturl', ''))
-            if arturl.startswith('file://'):
-                return arturl[7:]
-        return str(self.player.GetMetadata().get(key, ''))
+            value = get('mpris:artUrl')
+            if not value.startswith('file://'):
+                return ''
+            from urllib import unquote
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            value = unquote(value[7:]) # A URI, so eg spaces are %20
+        elif key in ('artist', 'genre'):
+            value = ', '.join(get('xesam:' + key))
+        elif key == 'track':
+            value = get('xesam:trackNumber')
+        elif key == 'year':
+            value = get('xesam:contentCreated')[:4]
+        elif key == 'rating':
+            value = int((get('xesam:userRating') or 0) * 10)
+        elif key == 'score':
+            value = int((get('xesam:autoRating') or 0) * 100)
+        elif key == 'nowPlaying':
+            value = ' - '.join([v for v in (self['artist'], self['title']) if v])
+        elif key == 'lyrics' or key == 'lyricsURL':
+            # Plain text, so wrap it up like Amarok's lyrics XML
+            value = get('xesam:asText')
+            if value:
+                from xml.sax.saxutils import escape
+                value = '<lyrics>%s</lyrics>' % escape(value)
+        else:
+            value = get('xesam:' + key)
+
+        if isinstance(value, unicode):
+            return value.encode('utf8')
+        return str(value)
+
+    def snapshot(self, keys):
+        "Returns a Track with the values of keys."
+        return Track([(key, self[key]) for key in keys])
 
     def is_playing(self):
-        return self.player.GetStatus()[0] == 0
+        return self.active is not None and \
+               self.players[self.active]['status'] == 'Playing'
 
     def listen(self):
+        "Generator that listens for events from the players."
         while True:
-            message = stdin.readline().strip()
-            if message in ('quit', ''):
-                exit(0)
-            assert message in ('playing', 'stopped')
-            yield message
+            yield self.next_event()
+
+    def next_event(self, timeout=None):
+        """
+        Returns the next event, or None if there was none within timeout
+        seconds or main_waker was woken. The main context is iterated until
+        then.
+        """
+        import gobject
+        expired = []
+        timer = None
+        if timeout is not None:
+            timer = gobject.timeout_add(int(timeout * 1000),
+                                        lambda: expired.append(True))
+        woken = []
+        watch = gobject.io_add_watch(main_waker.fd, gobject.IO_IN,
+                                     lambda fd, condition: woken.append(True))
+        while not self.events and not expired and not woken:
+            main_context.iteration(True)
+        if timer is not None and not expired:
+            gobject.source_remove(timer)
+        if not woken:
+            gobject.source_remove(watch)
+
+        if self.events:
+            return self.events.pop(0)
+        return None
+
+    def watch(self, callback):
+        "Calls callback with each event, instead of queueing it for listen."
+        self.callback = callback
+
+    def unwatch(self):
+        self.callback = None
 
     def passive_popup(self, msg):
-        # TODO send passive msg to Amarok 2
         pass
 
 
-class Amarok1(object):
+class PurpleState(object):
     """
-    Dictionary like interface to Amarok1's metadata. Uses Amaroks DCOP
-    interface.
+    Pidgin's state as last applied by AmarokPidgin: the current saved status,
+    the message of each saved status, the active accounts and each account's
+    alias. Writes which would not change anything are skipped.
+
+    The state is kept up to date by Pidgin's signals. If signals can't be
+    received (see init_mainloop) nothing is trusted, and every write is made.
+    The Pidgin sinks use it from their own threads, so lock is held while it
+    is read or written.
     """
-    def __getitem__(self, key):
-        if key == "lyricsURL": #URL is extracted from lyrics
-            value = getoutput("dcop amarok player lyrics 2> /dev/null")
+    interface = "im.pidgin.purple.PurpleInterface"
+
+    def __init__(self, purple, live):
+        self.purple   = purple
+        self.live     = live
+        self.current  = None # The current saved status, None if unknown
+        self.messages = {}   # saved status -> message
+        self.aliases  = {}   # account -> alias
+        self.accounts = None # The active accounts, None if unknown
+        self.expected = {}   # (kind, key) -> number of signals our writes cause
+        self.matches  = []
+        self.lock     = RLock()
+
+    def locked(self, func):
+        "Returns func wrapped to be called with lock held."
+        def call(*args):
+            self.lock.acquire()
+            try:
+                return func(*args)
+            finally:
+                self.lock.release()
+        return call
+
+    def watch(self, bus):
+        "Subscribes to the signals which invalidate the state."
+        for handler, name in ((self.savedstatus_changed, 'SavedstatusChanged'),
+                              (self.savedstatus_modified, 'SavedstatusModified'),
+                              (self.alias_changed, 'AccountAliasChanged'),
+                              (self.account_enabled, 'AccountEnabled'),
+                              (self.account_enabled, 'AccountSignedOn'),
+                              (self.account_disabled, 'AccountDisabled')):
+            self.matches.append(bus.add_signal_receiver(
+                self.locked(handler), name, PurpleState.interface))
+
+    def unwatch(self):
+        for match in self.matches:
+            match.remove()
+        self.matches = []
+
+    def wrote(self, kind, key):
+        "Notes that a write will cause a signal which should be ignored."
+        if self.live:
+            self.expected[kind, key] = self.expected.get((kind, key), 0) + 1
+
+    def is_expected(self, kind, key):
+        "Returns True if a signal was caused by our own write."
+        count = self.expected.get((kind, key), 0)
+        if count:
+            self.expected[kind, key] = count - 1
+        return count > 0
+
+    def savedstatus_changed(self, new, old):
+        self.current = new
+
+    def savedstatus_modified(self, status):
+        if not self.is_expected('message', status):
+            self.messages.pop(status, None)
+
+    def alias_changed(self, account, old):
+        if not self.is_expected('alias', account):
+            self.aliases.pop(account, None)
+
+    def account_enabled(self, account):
+        if self.accounts is not None and account not in self.accounts:
+            self.accounts.append(account)
+
+    def account_disabled(self, account):
+        if self.accounts is not None and account in self.accounts:
+            self.accounts.remove(account)
+
+    def get_accounts(self):
+        "Returns the active accounts."
+        pump_events()
+        self.lock.acquire()
+        try:
+            if self.accounts is None or not self.live:
+                self.accounts = list(self.purple.PurpleAccountsGetAllActive())
+            return list(self.accounts)
+        finally:
+            self.lock.release()
+
+    def get_current(self):
+        "Returns the current saved status."
+        pump_events()
+        self.lock.acquire()
+        try:
+            if self.current is None or not self.live:
+                self.current = self.purple.PurpleSavedstatusGetCurrent()
+            return self.current
+        finally:
+            self.lock.release()
+
+    def activate(self, status, force=False):
+        "Activates status, unless it is already active."
+        self.lock.acquire()
+        try:
+            if not force and self.live and self.get_current() == status:
+                return
+            self.purple.PurpleSavedstatusActivate(status)
+            self.current = status
+        finally:
+            self.lock.release()
+
+    def set_message(self, status, message):
+        "Sets the message of status. Returns True if it was changed."
+        pump_events()
+        self.lock.acquire()
+        try:
+            if self.live and self.messages.get(status) == message:
+                return False
+            self.wrote('message', status)
+            self.purple.PurpleSavedstatusSetMessage(status, message)
+            self.messages[status] = message
+            return True
+        finally:
+            self.lock.release()
+
+    def get_alias(self, account):
+        pump_events()
+        self.lock.acquire()
+        try:
+            if account not in self.aliases or not self.live:
+                self.aliases[account] = \
+                    self.purple.PurpleAccountGetAlias(account)
+            return self.aliases[account]
+        finally:
+            self.lock.release()
+
+    def set_alias(self, account, alias):
+        "Sets the alias of account, unless it already is alias."
+        pump_events()
+        self.lock.acquire()
+        try:
+            if self.live and self.aliases.get(account) == alias:
+                return
+            self.wrote('alias', account)
+            self.purple.PurpleAccountSetAlias(account, alias)
+            self.aliases[account] = alias
+        finally:
+            self.lock.release()
+
+
+class VariableMapTimeout(Exception):
+    pass
+
+
+class VariableMap(object):
+    """
+    The user's variable_map, compiled once per config load after running
+    variable_imports. Compiling is put off until the map is first used, so
+    it doesn't hold up startup. Results are memoized per (variable, value),
+    so the same artist or album is only mapped once. A call which raises or
+    takes longer than budget seconds leaves the value unmapped, and is tried
+    again the next time the value is seen.
+
+    stats holds [calls, cache hits, timeouts, seconds] for each variable.
+    """
+    def __init__(self, source, imports, budget):
+        self.source   = source
+        self.imports  = imports
+        self.budget   = budget
+        self.cache    = LRUCache(512)
+        self.stats    = {}
+        self.func     = None
+        self.compiled = False
+        self.status   = "variable_map not used yet"
+
+    def compile(self):
+        self.compiled = True
+        try:
+            namespace = {}
+            exec self.imports in namespace
+            self.func = eval(self.source, namespace)
+
+            # Quick sanity check on function. Not held to the budget, as the
+            # first call may be slow, eg while the map builds a table
+            assert isinstance(self.func("album",  "a test"), basestring)
+            assert isinstance(self.func("artist", ""), basestring)
+        except:
+            self.func = None
+            self.status = "Using identity variable_map"
         else:
-            value = getoutput("dcop amarok player %s 2> /dev/null" % key)
+            self.status = "variable_map passed sanity check"
 
-        if key == 'coverImage' and 'nocover' in value:
-            value = ''
+    def __call__(self, var, value):
+        if not self.compiled:
+            self.compile()
+        if self.func is None:
+            return value
 
-        return value.strip()
+        stats = self.stats.setdefault(var, [0, 0, 0, 0.0])
+        stats[0] += 1
+        if (var, value) in self.cache:
+            stats[1] += 1
+            return self.cache[var, value]
 
-    def is_playing(self):
-        return getoutput('dcop amarok player isPlaying 2> /dev/null').lower() == "true"
+        start = time()
+        try:
+            try:
+                result = self.timed_call(var, value)
+            except VariableMapTimeout:
+                stats[2] += 1
+                return value
+            except:
+                return value
+        finally:
+            stats[3] += time() - start
 
-    def listen(self):
+        self.cache[var, value] = result
+        return result
+
+    def timed_call(self, var, value):
         """
-        Generator that listens for messages from stdin.
+        Calls the variable map, raising VariableMapTimeout if it runs longer
+        than the budget. The budget is enforced with SIGALRM, so it is only
+        enforced in the main thread.
         """
-        while True:
-            message = stdin.readline()
+        if not hasattr(signal, 'setitimer') or not self.budget:
+            return self.func(var, value)
 
-            if len(message) == 0:
-                break
+        def alarm(signum, frame):
+            raise VariableMapTimeout()
+        try:
+            previous = signal.signal(signal.SIGALRM, alarm)
+        except ValueError: # Not the main thread
+            return self.func(var, value)
 
-            # Function that given a list, will tell you if any of the
-            # strings are in message
-            is_in = lambda li: len([x for x in li if x in message]) > 0
+        signal.setitimer(signal.ITIMER_REAL, self.budget)
+        try:
+            return self.func(var, value)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
 
-            if is_in( ("trackChange", "playing") ):
-                yield 'playing'
-            elif is_in( ("empty", "idle", "paused") ):
-                yield 'stopped'
-            elif "configure" in message:
-                yield 'configure'
+    def report(self):
+        "Returns a summary of the time spent in each mapped variable."
+        lines = [self.status]
+        for var, (calls, hits, timeouts, seconds) in sorted(self.stats.items()):
+            lines.append("variable_map %s: %d calls, %d cached, %d timeouts, "
+                         "%.1f ms" % (var, calls, hits, timeouts, seconds * 1000))
+        return '\n'.join(lines)
 
-    def passive_popup(self, msg):
-        getoutput("dcop amarok playlist popupMessage '%s' 2> /dev/null" % msg)
+
+class Settings(object):
+    """
+    Immutable, typed view of the AmarokPidgin section of the config. A new
+    Settings is built whenever the config is loaded, so the event handlers
+    read plain attributes instead of parsing strings through ConfigParser.
+    """
+    __slots__ = ('status_name', 'template', 'cover_icon', 'censor', 'display',
+                 'targets',
+                 'coalesce_window', 'min_update_interval', 'async_updates',
+                 'icon_cache_size', 'templates', 'rotate_interval',
+                 'variable_map', 'history_file')
+
+    def __init__(self, config):
+        get = lambda option: config.get("AmarokPidgin", option)
+        getfloat = lambda option: float(get(option).split('#')[0].strip() or 0)
+        getboolean = lambda option: get(option).split('#')[0].strip().lower() \
+                     in ('1', 'yes', 'true', 'on')
+
+        censor = None
+        if config.getboolean("AmarokPidgin", "censor"):
+            censor = Censor(get("censor_words"))
+
+        # Where the message is shown. Pidgin's is either nick or status
+        targets = parse_targets(get("display"))
+        kinds = [kind for kind, path, interval in targets]
+        display = 'status'
+        if 'nick' in kinds and 'status' not in kinds:
+            display = 'nick'
+
+        # status_message followed by the messages to rotate through
+        templates = [Template(get("status_message"), AmarokPidgin.variables)]
+        rotate_messages = get("rotate_messages").strip()
+        if rotate_messages and not rotate_messages.startswith('#'):
+            templates += [Template(message.strip(), AmarokPidgin.variables)
+                          for message in rotate_messages.split('|')]
+
+        history_file = get("history_file").split('#')[0].strip()
+        if history_file:
+            history_file = os.path.expanduser(history_file)
+
+        rotate_interval = getfloat("rotate_interval")
+        if rotate_interval > 0:
+            rotate_interval = max(rotate_interval, MIN_ROTATE_INTERVAL)
+
+        values = {
+            'status_name': get("status_name"),
+            'template':    templates[0],
+            'templates':   tuple(templates),
+            'rotate_interval': rotate_interval,
+            'cover_icon':  config.getboolean("AmarokPidgin", "cover_icon"),
+            'censor':      censor,
+            'display':     display,
+            'targets':     targets,
+            'coalesce_window':     getfloat("coalesce_window"),
+            'min_update_interval': getfloat("min_update_interval"),
+            'async_updates':       getboolean("async_updates"),
+            'icon_cache_size':     int(getfloat("icon_cache_size") * 1024 * 1024),
+            'variable_map': VariableMap(get("variable_map"),
+                                        get("variable_imports"),
+                                        getfloat("variable_map_budget")),
+            'history_file': history_file,
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable")
+
+
+class PidginRestarted(Exception):
+    "Raised when Pidgin's D-Bus service gets a new owner while connected."
 
 
 class AmarokPidgin(object):
     variables = ("album", "artist", "genre", "title", "track", "year",
-                 "nowPlaying", "lyricsURL", "lyrics", "score", "rating")
+                 "nowPlaying", "lyricsURL", "lyrics", "score", "rating",
+                 "lastTrack")
 
-    def __init__(self, amarok):
+    # Variables which aren't fetched from Amarok
+    local_variables = ("lastTrack",)
+
+    def __init__(self):
         """
-        Connects too Pidgin's dbus interface.
-        Stores the following variables:
-            default - The default status
-            purple - Pidgin dbus interface
-            status - The status id for AmarokPidgin
-            song - The songs string for the status. If not set, it is null
+        Reads in the configuration. Nothing is done with Pidgin until connect
+        is called, so the configuration and caches are kept when Pidgin
+        restarts.
         """
 
         if DEBUG:
-            import os
             self.logf = file("/tmp/AmarokPidgin.log", "a")
             print >>self.logf, "-"*60
-            print >>self.logf, "Using engine", type(amarok).__name__
             print >>self.logf, "Current working directory:", os.getcwd()
 
-        self.config = None
+        self.config         = None
+        self.settings       = None
+        self.purple         = None
+        self.sinks          = None # The sinks for settings.targets
+        self.icon_sink      = None
+        self.icons          = None
+        self.scaled_covers  = [] # Added to by the IconCache's thread
+        self.history        = None
+        self.history_failed = None # history_file which couldn't be used
+        self.play           = None # The play being timed for the history
+        self.encodings      = LRUCache(64) # (artist, album) -> encoding
         self.parse_config()
+        metrics.mark('configured')
+
+
+    def connect(self, amarok):
+        """
+        Connects too Pidgin's dbus interface.
+        Stores the following variables:
+            default - The default status
+            purple - Pidgin dbus interface
+            status - The status id for AmarokPidgin
+            song - The songs string for the status. If not set, it is null
+        """
+        self.log("Using engine %s" % type(amarok).__name__)
         self.amarok = amarok
+        if hasattr(amarok, 'invalidate'):
+            amarok.invalidate() # Events may have been missed while away
 
         # Get the purple object
         bus = dbus.SessionBus()
-        obj = bus.get_object("im.pidgin.purple.PurpleService",
-                             "/im/pidgin/purple/PurpleObject")
-        purple = dbus.Interface(obj, "im.pidgin.purple.PurpleInterface")
+        obj = bus.get_object(PURPLE_SERVICE, "/im/pidgin/purple/PurpleObject")
+        purple = CountedInterface(dbus.Interface(obj,
+                                     "im.pidgin.purple.PurpleInterface"))
+
+        self.default        = purple.PurpleSavedstatusGetCurrent()
+        self.purple         = purple
+        self.state          = PurpleState(purple, main_context is not None)
+        self.status         = self.find_status()
+        self.nicks          = {}
+        self.nicks_in_use   = set()
+        self.song           = None
+        self.revert_status  = False
+        self.track          = None
+        self.lyrics         = None
+        self.lyrics_line    = None
+        self.rotation       = 0
+        self.next_rotation  = None
+        self.last_update    = 0
+        self.pending        = None # Latest event not yet handled
+        self.deadline       = None # When pending should be handled
+        self.icon_sink      = PidginSink('icon', self.update_buddyicon,
+                                         self.restore_buddyicon,
+                                         self.state.lock, skip_unchanged=False)
+
+        self.owner_changed  = None # (new owner,) once Pidgin quits or restarts
+        self.owner_match    = None
+        if self.state.live:
+            self.state.watch(bus)
+            self.owner_match = bus.add_signal_receiver(
+                self.purple_owner_changed, 'NameOwnerChanged',
+                'org.freedesktop.DBus', arg0=PURPLE_SERVICE)
+        self.buddyicon      = None # Read when the buddy icon is first changed
+        metrics.mark('connected')
+
+        # If currently playing, change status
+        if amarok.is_playing():
+            self.song = self.get_currently_playing()
+            self.show_playing(self.song, True, self.track['coverImage'])
+            self.last_update = time()
+        self.log("Startup: %r" % metrics.marks)
+
+
+    def disconnect(self, restore=True):
+        """
+        Changes Pidgin's status, nicks and buddy icon back, as far as Pidgin
+        can still be reached. Safe to call more than once. restore is False
+        once Pidgin has restarted, since it has nothing of ours to undo.
+        """
+        self.stop_sinks()
+        if self.purple is None:
+            return
+
+        # Waits for a sink's update to finish, so it can't undo the restore
+        self.state.lock.acquire()
+        try:
+            self.state.unwatch()
+            if self.owner_match is not None:
+                self.owner_match.remove()
+                self.owner_match = None
+            if restore:
+                self.purple.PurpleSavedstatusActivate(self.default)
+                self.restore_nicks()
+                self.restore_buddyicon()
+        finally:
+            self.purple = None
+            self.state.lock.release()
+
+
+    def purple_owner_changed(self, name, old_owner, new_owner):
+        "Notes that Pidgin has quit or restarted, for check_pidgin to act on."
+        self.owner_changed = (new_owner,)
+        main_waker.wake()
+
 
-        # Get the status object
-        status_name = self.config.get("AmarokPidgin", "status_name")
+    def check_pidgin(self):
+        """
+        Raises PidginRestarted if Pidgin has restarted since connecting, or
+        a DBusException if it has quit.
+        """
+        if self.owner_changed is None:
+            return
+        new_owner = self.owner_changed[0]
+        self.owner_changed = None
+        if new_owner:
+            raise PidginRestarted(new_owner)
+        raise dbus.DBusException("%s has quit" % PURPLE_SERVICE)
+
+
+    def find_status(self):
+        "Returns the saved status for AmarokPidgin, creating it if necessary."
+        purple = self.purple
+        status_name = self.settings.status_name
         status = purple.PurpleSavedstatusFind(status_name)
 
         if status == 0: # Doesn't exist, create
@@ -179,34 +2048,7 @@ class AmarokPidgin(object):
                 status_type = purple.PurplePrimitiveGetTypeFromId("available")
             status = purple.PurpleSavedstatusNew(status_name, status_type)
 
-        self.default        = purple.PurpleSavedstatusGetCurrent()
-        self.purple         = purple
-        self.status         = status
-        self.nicks          = {}
-        self.nicks_in_use   = set()
-        self.song           = None
-        self.revert_status  = False
-        self.buddyicon      = purple.PurplePrefsGetPath("/pidgin/accounts/buddyicon")
-
-        # Load variable map
-        try:
-            self.variable_map = eval(self.config.get("AmarokPidgin", "variable_map"))
-            self.log("Loaded variable_map")
-
-            # Quick sanity check on function
-            assert isinstance(self.variable_map("album",  "a test"), basestring)
-            assert isinstance(self.variable_map("artist", ""), basestring)
-        except:
-            self.log("Using identity variable_map")
-            self.variable_map = lambda x,y: y
-        else:
-            self.log("variable_map passed sanity check")
-
-        # If currently playing, change status
-        if amarok.is_playing():
-            self.song = self.get_currently_playing()
-            self.update_display(self.song)
-            self.update_buddyicon(self.amarok['coverImage'])
+        return status
 
 
     def log(self,message):
@@ -219,7 +2061,13 @@ class AmarokPidgin(object):
 
 
     def parse_config(self):
-        "Reads in the configuration file."
+        """
+        Reads in the configuration file. If a value can't be parsed the
+        exception is raised, and the current configuration is kept.
+        """
+        self.config_checked = time()
+        self.config_mtime = self.get_config_mtime()
+
         config = ConfigParser()
 
         # Set Defaults
@@ -229,13 +2077,59 @@ class AmarokPidgin(object):
 
         # Read in config
         try:
-            config_fp = file("AmarokPidgin.ini", "r")
+            config_fp = file(CONFIG_FILE, "r")
             config.readfp(config_fp)
             config_fp.close()
         except:
-            self.log("Could not read in AmarokPidgin.ini")
+            self.log("Could not read in %s" % CONFIG_FILE)
 
+        settings = Settings(config)
         self.config = config
+        self.set_settings(settings)
+
+
+    def get_config_mtime(self):
+        "Returns the modification time of the config file, or None."
+        try:
+            return os.stat(CONFIG_FILE).st_mtime
+        except OSError:
+            return None
+
+
+    def check_config(self):
+        """
+        Reloads the configuration file if it has been modified. The file is
+        stat'd at most once every CONFIG_CHECK_INTERVAL seconds.
+        """
+        now = time()
+        if now - self.config_checked < CONFIG_CHECK_INTERVAL:
+            return
+        self.config_checked = now
+
+        if self.get_config_mtime() == self.config_mtime:
+            return
+
+        self.log("%s has changed, reloading" % CONFIG_FILE)
+        status_name = self.settings.status_name
+        try:
+            self.parse_config()
+        except Exception, e:
+            # Not retried until the file changes again
+            self.log("Keeping the previous configuration: %s" % e)
+            return
+        if self.settings.status_name != status_name:
+            self.status = self.find_status()
+
+
+    def set_settings(self, settings):
+        """
+        Replaces the settings, restoring the original Buddy Icon if cover_icon
+        has been switched off.
+        """
+        old, self.settings = self.settings, settings
+        if old is not None and old.cover_icon and not settings.cover_icon \
+               and self.icon_sink is not None:
+            self.send(self.icon_sink, None)
 
 
     def configure(self):
@@ -253,8 +2147,7 @@ class AmarokPidgin(object):
                 raise Exception('kdialog missing')
 
             # Configure display to use
-            current_display = self.config.get("AmarokPidgin", "display")
-            if current_display == "status":
+            if self.settings.display == "status":
                 selected = ("on","off")
             else:
                 selected = ("off","on")
@@ -264,7 +2157,15 @@ class AmarokPidgin(object):
             new_display = kdialog('radiolist', text)[1]
 
             if new_display in ('nick','status'):
-                self.config.set("AmarokPidgin", "display", new_display)
+                # Keep the targets outside of Pidgin
+                targets = [new_display]
+                for kind, path, interval in self.settings.targets:
+                    if kind in ('file', 'socket'):
+                        target = '%s:%s' % (kind, path)
+                        if interval:
+                            target += '@%g' % interval
+                        targets.append(target)
+                self.config.set("AmarokPidgin", "display", ', '.join(targets))
 
 
             # Configure status message
@@ -282,15 +2183,15 @@ class AmarokPidgin(object):
             msg = ("Would you like AmarokPidgin to update your Buddy Icon "
                    "with the currently playing track's album cover?")
             status = kdialog('yesno', '"%s"' % msg)[0] and 'false' or 'true'
-            if status == 'false':
-                self.restore_buddyicon()
             self.config.set('AmarokPidgin', 'cover_icon', status)
+            self.set_settings(Settings(self.config))
 
 
             # Write updated config file
-            config_fp = file("AmarokPidgin.ini", "w")
+            config_fp = file(CONFIG_FILE, "w")
             self.config.write(config_fp)
             config_fp.close()
+            self.config_mtime = self.get_config_mtime()
         except:
             self.log("Error occurred during config")
 
@@ -299,7 +2200,7 @@ class AmarokPidgin(object):
         "Changes the displayed status"
 
         # Update the status object if necessary
-        current = self.purple.PurpleSavedstatusGetCurrent()
+        current = self.state.get_current()
         if current != self.status:
             # Removing code adds functionality! :D
             #status_name = self.purple.PurpleSavedstatusGetTitle(self.status)
@@ -311,154 +2212,387 @@ class AmarokPidgin(object):
                 current = self.status
 
 
-        # Update Purple's status
-        self.purple.PurpleSavedstatusSetMessage(self.status, message)
+        # Update Purple's status. Activating pushes a new message to the
+        # accounts, so it is needed even if the status is already current.
+        changed = self.state.set_message(self.status, message)
         if current == self.status:
-            self.purple.PurpleSavedstatusActivate(self.status)
+            self.state.activate(self.status, force=changed)
+        self.revert_status = False
+
+
+    def _clear_status(self):
+        "Switches back to the default status if the media status is current."
+        if self.state.get_current() == self.status:
+            self.revert_status = True
+            self.state.activate(self.default)
+        self.log("Default: %d" % self.default)
 
 
     def _update_nick(self, message):
         "Changes the displayed nickname"
 
-        nick_ids = self.purple.PurpleAccountsGetAllActive()
+        nick_ids = self.state.get_accounts()
 
         for nick_id in nick_ids:
             # Store default nick
             if nick_id not in self.nicks:
-                nick = self.purple.PurpleAccountGetAlias(nick_id)
+                nick = self.state.get_alias(nick_id)
                 self.nicks[nick_id] = nick
 
             # Update nick
-            self.purple.PurpleAccountSetAlias(nick_id, message)
+            self.state.set_alias(nick_id, message)
 
             # Add to nicks in use, for checking when not in use
             self.nicks_in_use.add(nick_id)
 
         # Restore nicks
         for nick_id in self.nicks_in_use.difference(nick_ids):
-            self.purple.PurpleAccountSetAlias(nick_id, nick[nick_id])
+            self.state.set_alias(nick_id, self.nicks[nick_id])
+            self.nicks_in_use.discard(nick_id)
 
 
-    def decode(self, message):
-        "Tries to decode the message"
-        encodings = ['utf8', 'iso-8859-1']
+    def decode(self, message, key=None):
+        """
+        Tries to decode the message. UTF-8 (which includes ASCII) is tried
+        first, since almost all tags are in it. Otherwise the encoding which
+        last worked for key is tried, then chardet's guess if it is installed,
+        and finally iso-8859-1 which decodes anything. Tags from the same
+        album tend to share an encoding, so key is the track's artist and
+        album.
+        """
+        if isinstance(message, unicode):
+            return message
 
         try:
-            import chardet
-            encodings.append(chardet.detect(message)['encoding'])
-        except ImportError:
+            return message.decode('utf8')
+        except UnicodeDecodeError:
             pass
 
+        encodings = []
+        if key is not None and key in self.encodings:
+            encodings.append(self.encodings[key])
+
+        chardet = get_chardet()
+        if chardet:
+            guess = chardet.detect(message)['encoding']
+            if guess and guess not in encodings:
+                encodings.append(guess)
+
+        encodings.append('iso-8859-1')
+
         # Try and decode message
         for encoding in encodings:
             try:
-                message = message.decode(encoding)
-            except:
+                decoded = message.decode(encoding)
+            except (UnicodeDecodeError, LookupError):
                 self.log("DecodeError: Could not decode '%s' as %s" % \
                          (message, encoding))
             else:
-                return message
-
+                if key is not None:
+                    self.encodings[key] = encoding
+                return decoded
 
         self.log("DecodeError: No decodings worked. Using replace")
-        try:
-            return message.decode('utf8', 'replace')
-        except:
-            self.log("DecodeError: Replace decoding did not work. Returning raw message.")
-            return message
+        return message.decode('utf8', 'replace')
 
 
     def update_display(self, message):
-        "Changes the displayed message."
+        "Changes the displayed message on every sink."
 
-        message = self.decode(message)
         if not message:
             return
 
         # Censors message if necessary
-        if self.config.getboolean("AmarokPidgin", "censor"):
-            # Builds a regular expression for matching expletives
-            expletives = self.config.get("AmarokPidgin", "censor_words")
-            censor_re  = re.compile('(%s)' % expletives, re.IGNORECASE)
+        if self.settings.censor:
+            message = metrics.timed('censor', self.settings.censor, message)
+
+        for sink in self.get_sinks():
+            self.send(sink, message)
+
+        self.log("Updating %s: %d %s" % (self.settings.display, self.status,
+                                         message))
+
+
+    def get_sinks(self):
+        "Returns the sinks for the display setting, making them if needed."
+        targets = self.settings.targets
+        if self.sinks is not None and self.sinks[0] == targets:
+            return self.sinks[1]
+
+        self.stop_sinks(icon=False)
+        sinks = []
+        for kind, path, interval in targets:
+            if kind == 'status':
+                sink = PidginSink('status', self._update_status,
+                                  self._clear_status, self.state.lock,
+                                  interval)
+            elif kind == 'nick':
+                sink = PidginSink('nick', self._update_nick, lambda: None,
+                                  self.state.lock, interval)
+            elif kind == 'file':
+                sink = FileSink(path, interval)
+            else:
+                sink = SocketSink(path, interval)
+            sinks.append(sink)
+        self.sinks = (targets, sinks)
+        return sinks
 
-            # Returns the a censored version of the match's string
-            censor = lambda match: '*' * len(match.group(0))
 
-            # Censor the message
-            message = censor_re.sub(censor, message)
+    def all_sinks(self):
+        "Returns every sink which has been made."
+        sinks = []
+        if self.sinks is not None:
+            sinks += self.sinks[1]
+        if self.icon_sink is not None:
+            sinks.append(self.icon_sink)
+        return sinks
 
-        # Update the necessary display
-        display = self.config.get("AmarokPidgin", "display")
 
-        # Either nick or status. Defaults to status
-        if display != 'nick':
-            display = 'status'
-            self._update_status(message)
+    def send(self, sink, value):
+        """
+        Gives value to sink. If async_updates is set it is applied by the
+        sink's own thread, otherwise it is applied now.
+        """
+        if self.settings.async_updates:
+            sink.update(value)
         else:
-            self._update_nick(message)
+            sink.apply(value)
+
 
-        self.log("Updating %s: %d %s" % (display, self.status, message))
+    def check_sinks(self):
+        "Re-raises the exception from a failed update to a sink, if any."
+        for sink in self.all_sinks():
+            sink.check()
+
+
+    def stop_sinks(self, icon=True):
+        for sink in self.all_sinks():
+            if icon or sink is not self.icon_sink:
+                sink.stop()
+        self.sinks = None
+        if icon:
+            self.icon_sink = None
 
 
     def restore_nicks(self):
         "Restores the nicks to there defaults"
 
         for nick_id in self.nicks:
-            self.purple.PurpleAccountSetAlias(nick_id, self.nicks[nick_id])
+            self.state.set_alias(nick_id, self.nicks[nick_id])
+
+
+    def needed_keys(self, templates):
+        "Returns the keys that need to be fetched from amarok for templates."
+        keys = ["coverImage"]
+        if self.settings.history_file:
+            keys += ["artist", "album", "title"]
+        for template in templates:
+            keys += [var for var in template.fields if var not in keys and
+                     var not in AmarokPidgin.local_variables]
+        return keys
 
 
     def get_currently_playing(self):
-        "Gets the currently playing song from amarok."
-        new_status = self.config.get("AmarokPidgin", "status_message")
+        """
+        Gets the currently playing song from amarok. The metadata is fetched
+        in one snapshot, which is kept in self.track for rotate to reuse.
+        """
+        templates = self.settings.templates
+        self.track = metrics.timed('metadata', self.amarok.snapshot,
+                                   self.needed_keys(templates))
+        self.history_playing()
+        self.rotation = 0
+        self.lyrics_line = None
 
-        for var in AmarokPidgin.variables:
-            if not ("$" + var) in new_status:
-                continue
+        return metrics.timed('render', self.render, templates[0])
 
-            value = self.amarok[var]
+
+    def render(self, template):
+        """
+        Renders template with the metadata in self.track. Each value is
+        decoded to unicode before being passed to variable_map.
+        """
+        key = (self.track["artist"], self.track["album"])
+        values = {}
+        for var in template.fields:
+            value = self.track[var]
 
             if var == "year" and value == "0":
                 value = ''
-            if var == "title" and len(value) == 0:
-                # if title is empty, nowPlaying returns something reasonable
-                new_status = new_status.replace("$title", "$nowPlaying")
-                continue
-            if var.startswith("lyrics"):
-                try:
-                    l = ParseLyrics(value)
-                except xml.parsers.expat.ExpatError:
-                    pass
-                value = ''
-                if var == "lyrics" and l.lyrics:
-                    value = choice(l.lyrics).encode("utf8")
-                elif var == "lyricsURL" and l.page_url:
-                    value = l.page_url.encode("utf8")
+            if var == "lyrics":
+                lyrics = self.get_lyrics(value)
+                value = u''
+                if len(lyrics):
+                    if self.lyrics_line is None:
+                        from random import randrange
+                        self.lyrics_line = randrange(len(lyrics))
+                    value = lyrics.line(self.lyrics_line % len(lyrics))
+            elif var == "lyricsURL":
+                value = self.get_lyrics(value).page_url
+            elif var == "lastTrack":
+                value = self.last_track()
+            else:
+                value = metrics.timed('decode', self.decode, value, key)
+
+            value = self.settings.variable_map(var, value)
+            values[var] = metrics.timed('decode', self.decode, value, key)
+
+        # if title is empty, nowPlaying returns something reasonable
+        if "title" in values and len(self.track["title"]) == 0:
+            values["title"] = values["nowPlaying"]
+
+        return template.render(values)
+
+
+    def rotate(self):
+        """
+        Shows the next lyrics line and the next of the rotating messages,
+        using the metadata already fetched for the current track.
+        """
+        templates = self.settings.templates
+        self.rotation += 1
+        template = templates[self.rotation % len(templates)]
+        if self.lyrics_line is not None and "lyrics" in template.fields:
+            self.lyrics_line += 1
+
+        message = metrics.timed('render', self.render, template)
+        self.log("Rotating to: %s" % message)
+        if message != self.song:
+            self.song = message
+            self.show_playing(message, True, self.track['coverImage'])
+            self.last_update = time()
+
+
+    def schedule_rotation(self):
+        "Sets when rotate should next be called, if it should be at all."
+        settings = self.settings
+        self.next_rotation = None
+        if self.song is None or not settings.rotate_interval:
+            return
+
+        rotates = len(settings.templates) > 1
+        for template in settings.templates:
+            if "lyrics" in template.fields:
+                rotates = True
+        if rotates:
+            self.next_rotation = time() + settings.rotate_interval
+
+
+    def get_history(self):
+        """
+        Returns the PlayHistory for the history_file setting, or None. If the
+        database can't be used the history is switched off until history_file
+        is changed.
+        """
+        path = self.settings.history_file
+        if self.history is not None and self.history.path != path:
+            self.history.stop()
+            self.history = None
+        if self.history is None and path and path != self.history_failed:
+            self.history = PlayHistory(path)
+            self.history.open()
+
+        if self.history is not None and self.history.error is not None:
+            self.log("Play history switched off: %s" % self.history.error)
+            self.history_failed = path
+            self.history.stop()
+            self.history = None
+        return self.history
+
+
+    def history_playing(self):
+        """
+        Starts timing the track in self.track for the play history. If it is
+        the track that was paused, it carries on being timed.
+        """
+        history = self.get_history()
+        if history is None:
+            return
 
+        key = (self.track["artist"], self.track["album"])
+        track = tuple([self.decode(self.track[var], key)
+                       for var in ("artist", "album", "title")])
+        now = time()
+        if self.play is not None and self.play['track'] == track:
+            if self.play['since'] is None:
+                self.play['since'] = now
+            return
+
+        self.history_finish()
+        self.play = {'track': track, 'started': now, 'played': 0.0,
+                     'since': now}
+
+
+    def history_stopped(self):
+        "Stops timing the current track."
+        if self.play is not None and self.play['since'] is not None:
+            self.play['played'] += time() - self.play['since']
+            self.play['since'] = None
+
+
+    def history_finish(self):
+        "Adds the timed track to the play history."
+        if self.play is None:
+            return
+
+        self.history_stopped()
+        artist, album, title = self.play['track']
+        history = self.get_history()
+        if history is not None:
+            history.add(self.play['started'], artist, album, title,
+                        self.play['played'])
+        self.play = None
 
-            value = self.variable_map(var, value)
-            new_status = new_status.replace("$" + var, value)
 
-        return new_status
+    def stop_history(self):
+        "Adds the current track to the play history and writes it out."
+        self.history_finish()
+        if self.history is not None:
+            self.history.stop()
+            self.history = None
+
+
+    def last_track(self):
+        "Returns the previously played track for $lastTrack."
+        history = self.get_history()
+        if history is None:
+            return u''
+        last = history.last()
+        if last is None:
+            return u''
+        started, artist, album, title, played = last
+        return u' - '.join([value for value in (artist, title) if value])
+
+
+    def get_lyrics(self, lyric_xml):
+        "Returns the Lyrics for lyric_xml, which are parsed once per track."
+        if self.lyrics is None or self.lyrics[0] != lyric_xml:
+            self.lyrics = (lyric_xml, Lyrics(lyric_xml))
+        return self.lyrics[1]
 
 
     def update_buddyicon(self, cover):
         """
         Updates Pidgin's default Buddy Icon if the cover_icon setting is true
         """
-        if not self.config.getboolean("AmarokPidgin", "cover_icon"):
-            return
+        if self.settings.cover_icon:
+            self.set_buddyicon(cover)
+
 
+    def set_buddyicon(self, cover):
+        "Changes Pidgin's default Buddy Icon to cover, or back if it is ''."
         current = self.purple.PurplePrefsGetPath("/pidgin/accounts/buddyicon")
 
         # The current cover isn't an album cover, so update the fallback buddy
         # icon. This is just a heuristic, it won't always work.
-        if not 'albumcovers' in current:
+        if self.buddyicon is None or (not 'albumcovers' in current and
+                                      not current.startswith(ICON_CACHE_DIR)):
             self.buddyicon = current
 
         # Buddy Icon should be default if display is 'status' and the media
         # status is not selected.
-        display = self.config.get("AmarokPidgin", "display")
-        cur_status = self.purple.PurpleSavedstatusGetCurrent()
+        display = self.settings.display
+        cur_status = self.state.get_current()
         if cover != '' and display == 'status' and cur_status != self.status:
             cover = ''
             if current != self.buddyicon:
@@ -468,6 +2602,11 @@ class AmarokPidgin(object):
         # Switch back the original Buddy Icon
         if cover == '':
             cover = self.buddyicon
+        else:
+            cover = self.get_icon(cover)
+            if cover is None:
+                self.log("Waiting for the cover to be scaled")
+                return
 
         # Cover is the same, do not update
         if cover == current:
@@ -479,40 +2618,229 @@ class AmarokPidgin(object):
         self.purple.PurplePrefsSetPath("/pidgin/accounts/buddyicon", cover)
 
 
+    def get_icon(self, cover):
+        """
+        Returns the cover scaled to buddy icon size, or None if it is being
+        scaled. Once it is, the buddy icon is updated if cover is still the
+        current track's.
+        """
+        if self.icons is None:
+            self.icons = IconCache(ICON_CACHE_DIR,
+                                   self.settings.icon_cache_size,
+                                   self.icon_ready)
+        self.icons.max_bytes = self.settings.icon_cache_size
+        return self.icons.get(cover)
+
+
+    def icon_ready(self, cover):
+        """
+        Called by the IconCache's thread when cover has been scaled. Pidgin
+        is only called from the main thread, so the buddy icon is updated by
+        the tick which waking the event loop leads to.
+        """
+        self.scaled_covers.append(cover)
+        main_waker.wake()
+
+
+    def show_scaled_covers(self):
+        "Updates the buddy icon if a cover scaled is still the current one."
+        while self.scaled_covers:
+            cover = self.scaled_covers.pop(0)
+            sink = self.icon_sink # May be stopped by disconnect meanwhile
+            if sink is not None and self.song is not None and \
+                   self.track['coverImage'] == cover:
+                self.send(sink, cover)
+
+
     def restore_buddyicon(self):
-        self.update_buddyicon('')
+        """
+        Switches back to the original Buddy Icon. This doesn't depend on
+        cover_icon, so it still happens once cover_icon has been switched off.
+        """
+        if self.buddyicon is not None:
+            self.set_buddyicon('')
 
 
     def listen(self):
         """
-        Listens for events from Amarok.
+        Listens for events from Amarok on stdin. Between events, any D-Bus
+        signals which have arrived are dispatched and due work is done by
+        tick.
         """
-        for action in self.amarok.listen():
-            if action == 'playing':
-                message = self.get_currently_playing()
-                self.log("Previously Playing: %s" % self.song)
-                self.log("Currently Playing: %s" % message)
+        self.schedule_rotation()
 
-                # The song has changed, update status
-                if message != self.song:
-                    self.song = message
-                    self.update_display(message)
+        while True:
+            wakeup = self.next_wakeup()
+            timeout = None
+            if wakeup is not None:
+                timeout = max(0, wakeup - time())
+
+            action = self.amarok.next_event(timeout)
+            main_waker.clear()
+            pump_events()
+            metrics.handle_requests()
+            self.check_pidgin()
+            self.check_sinks()
+
+            if action is None:
+                self.tick()
+            else:
+                self.push(action)
 
-                self.update_buddyicon(self.amarok['coverImage'])
 
-                self.revert_status = False
+    def run(self):
+        """
+        Runs a glib main loop with the engine pushing events from D-Bus
+        signals, instead of reading them from stdin. An exception raised in a
+        callback stops the loop and is re-raised.
+        """
+        import gobject
+        self.loop  = gobject.MainLoop()
+        self.timer = None
+        self.error = None
+
+        def guard(func):
+            def guarded(*args):
+                try:
+                    func(*args)
+                    self.check_pidgin()
+                    self.check_sinks()
+                    self.schedule_wakeup()
+                except:
+                    self.error = sys.exc_info()
+                    self.loop.quit()
+                return False
+            return guarded
+
+        def on_timer():
+            self.timer = None
+            self.tick()
+        self.on_timer = guard(on_timer)
+
+        global main_loop_running
+        metrics.on_request = lambda: gobject.idle_add(
+            guard(metrics.handle_requests))
+        # guard's schedule_wakeup then picks up whatever woke the loop
+        main_waker.on_wake = lambda: gobject.idle_add(guard(lambda: None))
+        self.amarok.watch(guard(self.push))
+        self.schedule_rotation()
+        self.schedule_wakeup()
+        main_loop_running = True
+        try:
+            self.loop.run()
+        finally:
+            main_loop_running = False
+            metrics.on_request = None
+            main_waker.on_wake = None
+            self.amarok.unwatch()
+
+        if self.error:
+            error, self.error = self.error, None
+            raise error[0], error[1], error[2]
+
+
+    def schedule_wakeup(self):
+        "Sets the glib timer used by run to call tick."
+        import gobject
+        if self.timer is not None:
+            gobject.source_remove(self.timer)
+            self.timer = None
+
+        wakeup = self.next_wakeup()
+        if wakeup is not None:
+            delay = max(0, int((wakeup - time()) * 1000))
+            self.timer = gobject.timeout_add(delay, self.on_timer)
+
+
+    def push(self, action):
+        """
+        Receives an event from Amarok. Bursts of events, such as when
+        skipping through a playlist, are coalesced: only the last event in a
+        coalesce_window is handled, and Pidgin is updated at most once every
+        min_update_interval seconds.
+        """
+        metrics.count('events')
+        self.check_config()
+        if action == 'configure':
+            self.handle(action)
+            return
+
+        if self.pending is None:
+            settings = self.settings
+            self.deadline = max(time() + settings.coalesce_window,
+                                self.last_update + settings.min_update_interval)
+        else:
+            metrics.count('coalesced')
+        self.pending = action
+
+
+    def next_wakeup(self):
+        "Returns when tick next needs to be called, or None."
+        wakeups = [when for when in (self.deadline, self.next_rotation)
+                   if when is not None]
+        if self.scaled_covers:
+            wakeups.append(time())
+        if wakeups:
+            return min(wakeups)
+        return None
 
-            elif action == 'stopped':
-                if self.purple.PurpleSavedstatusGetCurrent() == self.status:
-                    self.revert_status = True
-                    self.purple.PurpleSavedstatusActivate(self.default)
-                self.song = None
-                self.restore_buddyicon()
 
-                self.log("Default: %d" % self.default)
+    def tick(self):
+        """
+        Handles the pending event once its burst is over. While a track plays,
+        rotate is called every rotate_interval seconds.
+        """
+        if self.scaled_covers:
+            self.show_scaled_covers()
+
+        now = time()
+        if self.pending is not None and now >= self.deadline:
+            metrics.count('updates')
+            self.handle(self.pending)
+            self.last_update = time()
+            self.pending, self.deadline = None, None
+            self.schedule_rotation()
+        elif self.next_rotation is not None and now >= self.next_rotation:
+            self.rotate()
+            self.schedule_rotation()
+
+
+    def handle(self, action):
+        "Updates Pidgin for an event from Amarok."
+        if action == 'playing':
+            message = self.get_currently_playing()
+            self.log("Previously Playing: %s" % self.song)
+            self.log("Currently Playing: %s" % message)
+
+            changed = message != self.song
+            self.song = message
+            self.show_playing(message, changed, self.track['coverImage'])
+            if self.settings.variable_map.stats:
+                self.log(self.settings.variable_map.report())
+
+        elif action == 'stopped':
+            self.song = None
+            self.history_stopped()
+            self.show_stopped()
+
+        elif action == 'configure':
+            self.configure()
 
-            elif action == 'configure':
-                self.configure()
+
+    def show_playing(self, message, changed, cover):
+        "Displays message, and cover as the buddy icon."
+        # The song has changed, update status
+        if changed:
+            self.update_display(message)
+
+        self.send(self.icon_sink, cover)
+
+
+    def show_stopped(self):
+        "Switches back to the default status and buddy icon."
+        for sink in self.get_sinks():
+            self.send(sink, None)
+        self.send(self.icon_sink, None)
 
 
 # Made a global for cleanup script
@@ -520,17 +2848,15 @@ amarokPidgin = None
 
 def cleanup(signum, frame):
     "Tries to change the status back to the default"
-    global amarokPidgin
     try:
         if amarokPidgin:
-            amarokPidgin.purple.PurpleSavedstatusActivate(amarokPidgin.default)
-            amarokPidgin.restore_nicks()
-            amarokPidgin.restore_buddyicon()
-            amarokPidgin = None
+            amarokPidgin.disconnect()
     except:
         pass
 
     if signum in (signal.SIGTERM, signal.SIGKILL):
+        if amarokPidgin:
+            amarokPidgin.stop_history()
         exit(0)
 
 def log_exception():
@@ -542,24 +2868,58 @@ def log_exception():
         logf.close()
 
 if __name__ == "__main__":
+    # amarok2 reads events from MPRISPidgin.py, while mpris subscribes to
+    # Amarok 2's signals itself in a single process. mpris2 follows any
+    # MPRIS2 player.
+    metrics.mark('imported')
+    mode = 'amarok1'
+    if len(argv) > 1:
+        mode = argv[1]
+
     interfacecls = Amarok1
-    if len(argv) > 1 and argv[1] == 'amarok2':
+    if mode in ('amarok2', 'mpris'):
         interfacecls = Amarok2
+    elif mode == 'mpris2':
+        interfacecls = MPRIS2
+    if mode in ('mpris', 'mpris2'):
+        # Amarok 2 starts scripts in its own directory
+        os.chdir(os.path.dirname(os.path.abspath(argv[0])))
 
     signal.signal(signal.SIGTERM, cleanup)
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, metrics.request)
+        signal.siginterrupt(signum, False) # Restart reads instead of failing
+    # Wakes the wait in wait_readable, which glib would otherwise restart
+    signal.set_wakeup_fd(main_waker.write_fd)
+    if not init_mainloop() and mode in ('mpris', 'mpris2'):
+        exit("python-gobject is needed to use %s" % mode)
+    amarokPidgin = AmarokPidgin()
+    interface = None
+    delay = MIN_RECONNECT_DELAY
     while True:
         try:
-            interface = interfacecls()
-            amarokPidgin = AmarokPidgin(interface)
-            amarokPidgin.listen()
+            if interface is None:
+                interface = interfacecls()
+            amarokPidgin.connect(interface)
+            delay = MIN_RECONNECT_DELAY
+            if mode in ('mpris', 'mpris2'):
+                amarokPidgin.run()
+            else:
+                amarokPidgin.listen()
+        except PidginRestarted:
+            # Pidgin is already back, so reconnect straight away
+            amarokPidgin.disconnect(restore=False)
+            log_exception()
         except dbus.DBusException:
-            # This usually means Pidgin has closed.  Change the status
-            # as well as sleep for 20 seconds, hoping Pidgin would have
-            # started up.
+            # This usually means Pidgin has closed. Change the status back
+            # and wait for Pidgin to start up again, trying again sooner if
+            # it does.
             cleanup(0,0)
             log_exception()
-            sleep(20)
+            wait_for_pidgin(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
         except: # Unexpected error, don't carry on looping
             cleanup(0,0)
+            amarokPidgin.stop_history()
             log_exception()
             raise
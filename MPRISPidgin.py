@@ -2,33 +2,127 @@
 # Keegan Carruthers-Smith 2009 <keegan.csmith@gmail.com>
 # Distributed under the GPLv2
 
-import dbus, dbus.glib
-import os, os.path, sys, signal
+import errno, fcntl, os, os.path, sys, signal
 from subprocess import Popen, PIPE, STDOUT
 
+# AmarokPidgin.py is started before the slower imports, so both processes
+# start up at the same time.
 os.chdir(os.path.dirname(sys.argv[1]))
 args = ('python', sys.argv[1], 'amarok2')
 amarokpidgin = Popen(args, bufsize=1, stdin=PIPE)
 
+import dbus, dbus.glib
+import gobject
+from time import time
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+# Version of the messages sent to AmarokPidgin.py
+PROTOCOL_VERSION = 1
+
+# Metadata of the current track, sent along with every playing event so that
+# AmarokPidgin.py does not need to query Amarok itself.
+metadata = None
+
+
+class Channel(object):
+    """
+    Sends messages to AmarokPidgin.py, one JSON object per line, without
+    ever blocking. If AmarokPidgin.py is slow to read, the message being
+    written is finished from the main loop, and of the messages sent in the
+    meantime only the latest is kept.
+    """
+    def __init__(self, fd):
+        self.fd      = fd
+        self.writing = '' # Rest of the message being written
+        self.latest  = None # Message to write after it
+        self.watch   = None
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def send(self, event, payload=None):
+        message = {'v': PROTOCOL_VERSION, 'type': event, 'ts': time(),
+                   'payload': payload or {}}
+        line = json.dumps(message) + '\n'
+        if self.writing:
+            self.latest = line
+        else:
+            self.writing = line
+        self.flush()
+
+    def flush(self):
+        "Writes what it can, and waits for the pipe to drain for the rest."
+        self.write()
+        if self.writing and self.watch is None:
+            self.watch = gobject.io_add_watch(self.fd, gobject.IO_OUT,
+                                              self.writable)
+
+    def writable(self, fd, condition):
+        self.write()
+        if self.writing:
+            return True
+        self.watch = None
+        return False
+
+    def write(self):
+        while self.writing:
+            try:
+                written = os.write(self.fd, self.writing)
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return
+            self.writing = self.writing[written:]
+            if not self.writing and self.latest:
+                self.writing, self.latest = self.latest, None
+
+channel = Channel(amarokpidgin.stdin.fileno())
+
+
+def send(event, metadata=None):
+    payload = {}
+    if metadata is not None:
+        payload['metadata'] = metadata
+    channel.send(event, payload)
+
+
+def to_json(mpris_metadata):
+    "Converts a dbus metadata dictionary to plain unicode strings."
+    return dict((unicode(k), unicode(v)) for k, v in mpris_metadata.items())
+
 
 def statusChanged(status, *args):
+    global metadata
     if status[0] == 0:
-        msg = 'playing'
+        if metadata is None:
+            obj = dbus.SessionBus().get_object('org.mpris.amarok', '/Player')
+            player = dbus.Interface(obj, 'org.freedesktop.MediaPlayer')
+            metadata = to_json(player.GetMetadata())
+        send('playing', metadata)
     else:
-        msg = 'stopped'
-    amarokpidgin.stdin.write(msg + '\n')
-    amarokpidgin.stdin.flush()
+        send('stopped')
+
+
+def trackChanged(mpris_metadata, *args):
+    global metadata
+    metadata = to_json(mpris_metadata)
+    send('playing', metadata)
 
 
 def init_dbus():
     bus = dbus.SessionBus()
     bus.add_signal_receiver(statusChanged, 'StatusChange',
                             'org.freedesktop.MediaPlayer')
+    bus.add_signal_receiver(trackChanged, 'TrackChange',
+                            'org.freedesktop.MediaPlayer')
 
 
 def cleanup(signum, frame):
     if signum in (signal.SIGTERM, signal.SIGKILL):
-        amarokpidgin.stdin.write('quit\n')
+        send('quit')
         sys.exit(0)
 
 
@@ -37,7 +131,6 @@ if __name__ == "__main__":
 
     init_dbus()
 
-    import gobject
     loop = gobject.MainLoop()
     try:
         loop.run()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Distributed under the GPLv2
+"""
+Measures the throughput of AmarokPidgin's censor filter for word lists of
+different sizes. Run from the AmarokPidgin directory:
+
+    python benchmarks/censor.py
+"""
+
+import os, sys
+from random import Random
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from AmarokPidgin import Censor
+
+SIZES    = (10, 1000, 50000)
+MESSAGES = 2000
+
+
+def words(count, rand):
+    "Returns count distinct random lower case words."
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    result = set()
+    while len(result) < count:
+        length = rand.randint(3, 10)
+        result.add(''.join([rand.choice(letters) for i in range(length)]))
+    return sorted(result)
+
+
+def messages(expletives, rand):
+    "Returns status messages with an expletive in roughly every other one."
+    result = []
+    for i in range(MESSAGES):
+        message = u'Listening to Song %d by Some Artist on An Album [Amarok]' % i
+        if i % 2:
+            message += u' ' + rand.choice(expletives).capitalize()
+        result.append(message)
+    return result
+
+
+def bench(size, rand):
+    expletives = words(size, rand)
+    sample = messages(expletives, rand)
+
+    start = time()
+    censor = Censor('|'.join(expletives))
+    compile_time = time() - start
+
+    start = time()
+    for message in sample:
+        censor(message)
+    elapsed = time() - start
+
+    print '%6d words: compile %8.2f ms, %9.0f messages/s' % \
+          (size, compile_time * 1000, len(sample) / elapsed)
+
+
+if __name__ == '__main__':
+    rand = Random(0)
+    for size in SIZES:
+        bench(size, rand)
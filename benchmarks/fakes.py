@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Distributed under the GPLv2
+"""
+Stand-ins for Pidgin's and Amarok 2's D-Bus services, used by
+benchmarks/pipeline.py. They answer the calls AmarokPidgin makes and count
+them. Each message Pidgin is asked to show is recorded with the time it
+arrived. Run on a private bus:
+
+    DBUS_SESSION_BUS_ADDRESS=... python benchmarks/fakes.py
+
+"ready" is printed once the services' names have been taken.
+"""
+
+import sys
+from time import time
+
+import dbus
+import dbus.service
+import dbus.mainloop.glib
+import gobject
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+PURPLE = 'im.pidgin.purple.PurpleInterface'
+PLAYER = 'org.freedesktop.MediaPlayer'
+BENCH  = 'org.AmarokPidgin.Bench'
+
+
+class Recorder(object):
+    "Counts calls, and records the messages displayed."
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls    = {}
+        self.messages = [] # [time, message]
+
+    def call(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def display(self, message):
+        self.messages.append([time(), message])
+
+
+class FakePurple(dbus.service.Object):
+    "The part of Pidgin's PurpleInterface that AmarokPidgin uses."
+    def __init__(self, bus, recorder):
+        dbus.service.Object.__init__(self, bus, '/im/pidgin/purple/PurpleObject')
+        self.recorder = recorder
+        self.current  = 1
+        self.statuses = {1: 'Available'} # id -> title
+        self.messages = {}
+        self.prefs    = {'/pidgin/accounts/buddyicon': ''}
+        self.aliases  = {101: 'me', 102: 'me@work'}
+
+    @dbus.service.method(PURPLE, in_signature='', out_signature='i')
+    def PurpleSavedstatusGetCurrent(self):
+        self.recorder.call('PurpleSavedstatusGetCurrent')
+        return self.current
+
+    @dbus.service.method(PURPLE, in_signature='s', out_signature='i')
+    def PurpleSavedstatusFind(self, title):
+        self.recorder.call('PurpleSavedstatusFind')
+        for status, name in self.statuses.items():
+            if name == title:
+                return status
+        return 0
+
+    @dbus.service.method(PURPLE, in_signature='si', out_signature='i')
+    def PurpleSavedstatusNew(self, title, status_type):
+        self.recorder.call('PurpleSavedstatusNew')
+        status = max(self.statuses) + 1
+        self.statuses[status] = title
+        return status
+
+    @dbus.service.method(PURPLE, in_signature='s', out_signature='i')
+    def PurplePrimitiveGetTypeFromId(self, name):
+        self.recorder.call('PurplePrimitiveGetTypeFromId')
+        return 2
+
+    @dbus.service.method(PURPLE, in_signature='i', out_signature='')
+    def PurpleSavedstatusActivate(self, status):
+        self.recorder.call('PurpleSavedstatusActivate')
+        self.current = status
+
+    @dbus.service.method(PURPLE, in_signature='is', out_signature='')
+    def PurpleSavedstatusSetMessage(self, status, message):
+        self.recorder.call('PurpleSavedstatusSetMessage')
+        self.messages[status] = message
+        self.recorder.display(message)
+
+    @dbus.service.method(PURPLE, in_signature='s', out_signature='s')
+    def PurplePrefsGetPath(self, name):
+        self.recorder.call('PurplePrefsGetPath')
+        return self.prefs.get(name, '')
+
+    @dbus.service.method(PURPLE, in_signature='ss', out_signature='')
+    def PurplePrefsSetPath(self, name, value):
+        self.recorder.call('PurplePrefsSetPath')
+        self.prefs[name] = value
+
+    @dbus.service.method(PURPLE, in_signature='', out_signature='ai')
+    def PurpleAccountsGetAllActive(self):
+        self.recorder.call('PurpleAccountsGetAllActive')
+        return sorted(self.aliases)
+
+    @dbus.service.method(PURPLE, in_signature='i', out_signature='s')
+    def PurpleAccountGetAlias(self, account):
+        self.recorder.call('PurpleAccountGetAlias')
+        return self.aliases[account]
+
+    @dbus.service.method(PURPLE, in_signature='is', out_signature='')
+    def PurpleAccountSetAlias(self, account, alias):
+        self.recorder.call('PurpleAccountSetAlias')
+        self.aliases[account] = alias
+        self.recorder.display(alias)
+
+
+class FakeAmarok(dbus.service.Object):
+    "Amarok 2's MPRIS player. The track is set by the benchmark."
+    def __init__(self, bus, recorder):
+        dbus.service.Object.__init__(self, bus, '/Player')
+        self.recorder = recorder
+        self.playing  = False
+        self.metadata = {}
+
+    @dbus.service.method(PLAYER, in_signature='', out_signature='(iiii)')
+    def GetStatus(self):
+        self.recorder.call('GetStatus')
+        return ([2, 0][self.playing], 0, 0, 0) # 0 is playing, 2 stopped
+
+    @dbus.service.method(PLAYER, in_signature='', out_signature='a{sv}')
+    def GetMetadata(self):
+        self.recorder.call('GetMetadata')
+        return self.metadata
+
+
+class Bench(dbus.service.Object):
+    "Lets the benchmark set the track and collect what was recorded."
+    def __init__(self, bus, recorder, amarok):
+        dbus.service.Object.__init__(self, bus, '/Bench')
+        self.recorder = recorder
+        self.amarok   = amarok
+
+    @dbus.service.method(BENCH, in_signature='a{ss}b', out_signature='')
+    def SetTrack(self, metadata, playing):
+        self.amarok.metadata = dict(metadata)
+        self.amarok.playing  = playing
+
+    @dbus.service.method(BENCH, in_signature='', out_signature='s')
+    def Stats(self):
+        return json.dumps({'calls': self.recorder.calls,
+                           'messages': self.recorder.messages})
+
+    @dbus.service.method(BENCH, in_signature='', out_signature='')
+    def Reset(self):
+        self.recorder.reset()
+
+
+def main():
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    names = [dbus.service.BusName(name, bus) for name in
+             ('im.pidgin.purple.PurpleService', 'org.mpris.amarok',
+              'org.AmarokPidgin.Bench')]
+
+    recorder = Recorder()
+    amarok = FakeAmarok(bus, recorder)
+    services = [FakePurple(bus, recorder), amarok,
+                Bench(bus, recorder, amarok)]
+
+    print 'ready'
+    sys.stdout.flush()
+    gobject.MainLoop().run()
+
+
+if __name__ == '__main__':
+    main()
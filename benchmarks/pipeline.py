@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# Distributed under the GPLv2
+"""
+Measures AmarokPidgin's event pipeline end to end, without a live Pidgin or
+Amarok. A private dbus-daemon is started with the fake services from
+benchmarks/fakes.py, and a fake dcop is put on PATH for Amarok 1. Event
+streams are then replayed into AmarokPidgin.py's stdin, as Amarok or
+MPRISPidgin.py would send them, and for each engine and stream this
+reports:
+
+* events/s: events replayed over the time until the last update arrived
+* latency: from an event being sent until Pidgin was asked to show it
+* D-Bus calls (and dcop calls for Amarok 1) per event
+
+Run from the AmarokPidgin directory:
+
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --engines amarok1 --streams skipping
+    python benchmarks/pipeline.py --stream-file recorded.txt
+
+A recorded stream has one event per line: the seconds to wait before it,
+then playing or stopped. Each playing event starts a new track.
+"""
+
+import os, shutil, signal, subprocess, sys, tempfile
+from optparse import OptionParser
+from time import sleep, time
+
+import dbus
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT    = os.path.join(BENCH_DIR, os.pardir, 'AmarokPidgin.py')
+
+sys.path.insert(0, os.path.join(BENCH_DIR, os.pardir))
+from AmarokPidgin import PROTOCOL_VERSION
+
+ENGINES = ('amarok1', 'amarok2')
+
+# Seconds to wait for the last update before giving up on it
+SETTLE_TIMEOUT = 10
+
+CONFIG = """[AmarokPidgin]
+status_message = $title
+coalesce_window = %(coalesce_window)s
+min_update_interval = %(min_update_interval)s
+async_updates = %(async_updates)s
+"""
+
+FAKE_DCOP = """#!/bin/sh
+# dcop amarok player <call>, answered from the track file the benchmark writes
+echo "$3" >> "$BENCH_DIR/dcop.log"
+. "$BENCH_DIR/track"
+case "$3" in
+    isPlaying) echo $playing ;;
+    title) echo "$title" ;;
+    artist) echo Artist ;;
+    album) echo Album ;;
+    coverImage) echo /nocover.png ;;
+esac
+"""
+
+
+def steady():
+    "A track change every 20 ms."
+    return [(0.02, 'playing')] * 200
+
+def skipping():
+    "Bursts of 10 track changes, as when skipping through a playlist."
+    return ([(0.2, 'playing')] + [(0, 'playing')] * 9) * 20
+
+def pausing():
+    "Tracks which are stopped 50 ms after they start."
+    return [(0.05, 'playing'), (0.05, 'stopped')] * 100
+
+STREAMS = {'steady': steady, 'skipping': skipping, 'pausing': pausing}
+
+
+def read_stream(path):
+    "Reads a recorded stream of 'delay event' lines."
+    stream = []
+    for line in file(path):
+        if line.strip() and not line.startswith('#'):
+            delay, event = line.split()
+            stream.append((float(delay), event))
+    return stream
+
+
+def start_bus(env):
+    "Starts a private dbus-daemon, returning the process and its address."
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork',
+                               '--print-address'], stdout=subprocess.PIPE,
+                              env=env)
+    return daemon, daemon.stdout.readline().strip()
+
+
+def stop(process, timeout=5):
+    "Waits for process to exit, killing it if it takes too long."
+    deadline = time() + timeout
+    while process.poll() is None and time() < deadline:
+        sleep(0.05)
+    if process.poll() is None:
+        os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+class Replay(object):
+    "Replays a stream of events into AmarokPidgin.py running engine."
+    def __init__(self, engine, tmp, env, bench):
+        self.engine = engine
+        self.tmp    = tmp
+        self.env    = env
+        self.bench  = bench
+        self.track  = 0
+
+    def set_track(self, playing):
+        if self.engine == 'amarok1':
+            # Replaced in one go, so dcop never sees half a track file
+            path = os.path.join(self.tmp, 'track')
+            out = file(path + '.tmp', 'w')
+            print >>out, "playing=%s" % (playing and 'true' or 'false')
+            print >>out, "title='%s'" % self.title()
+            out.close()
+            os.rename(path + '.tmp', path)
+        else:
+            self.bench.SetTrack(self.metadata(), playing)
+
+    def title(self):
+        return 'Title %d' % self.track
+
+    def metadata(self):
+        return {'title': self.title(), 'artist': 'Artist', 'album': 'Album'}
+
+    def line(self, event):
+        "Returns the line Amarok or MPRISPidgin.py would send for event."
+        if self.engine == 'amarok1':
+            if event == 'playing':
+                return 'trackChange\n'
+            return 'engineStateChange: paused\n'
+
+        payload = {}
+        if event == 'playing':
+            payload['metadata'] = self.metadata()
+        return json.dumps({'v': PROTOCOL_VERSION, 'type': event,
+                           'ts': time(), 'payload': payload}) + '\n'
+
+    def start(self):
+        self.set_track(False)
+        self.process = subprocess.Popen([sys.executable, SCRIPT, self.engine],
+                                        stdin=subprocess.PIPE, cwd=self.tmp,
+                                        env=self.env)
+
+        # Wait until it has connected to the fake Pidgin
+        deadline = time() + SETTLE_TIMEOUT
+        while 'PurpleSavedstatusFind' not in self.stats()['calls']:
+            if time() > deadline or self.process.poll() is not None:
+                raise RuntimeError('AmarokPidgin.py %s did not start'
+                                   % self.engine)
+            sleep(0.05)
+        sleep(0.2)
+        self.bench.Reset()
+        dcop_log = os.path.join(self.tmp, 'dcop.log')
+        if os.path.exists(dcop_log):
+            os.remove(dcop_log)
+
+    def stats(self):
+        return json.loads(self.bench.Stats())
+
+    def run(self, stream):
+        "Replays stream, returning the send time of each track's message."
+        sent = {}
+        last = None
+        for delay, event in stream:
+            if delay:
+                sleep(delay)
+            if event == 'playing':
+                self.track += 1
+                last = self.title()
+            if self.engine == 'amarok1': # MPRISPidgin.py sends the metadata
+                self.set_track(event == 'playing')
+            if event == 'playing':
+                sent[self.title()] = time()
+            self.process.stdin.write(self.line(event))
+            self.process.stdin.flush()
+
+        # Wait for the last track to be shown, or things to go quiet
+        deadline = time() + SETTLE_TIMEOUT
+        calls = None
+        while time() < deadline:
+            stats = self.stats()
+            if last in [message for when, message in stats['messages']]:
+                break
+            if stats['calls'] == calls:
+                break
+            calls = stats['calls']
+            sleep(0.5)
+        return sent
+
+    def finish(self):
+        self.process.stdin.close()
+        stop(self.process)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench(engine, name, stream, tmp, env, bench_service):
+    replay = Replay(engine, tmp, env, bench_service)
+    replay.start()
+    try:
+        start = time()
+        sent = replay.run(stream)
+        stats = replay.stats()
+    finally:
+        replay.finish()
+
+    latencies = [(when - sent[message]) * 1000
+                 for when, message in stats['messages'] if message in sent]
+    end = max([when for when, message in stats['messages']] or [time()])
+    calls = sum(stats['calls'].values())
+
+    result = '%-8s %-9s %7.0f events/s' % (engine, name,
+                                           len(stream) / (end - start))
+    if latencies:
+        result += '  latency p50 %6.1f  p90 %6.1f  p99 %6.1f ms' % \
+                  (percentile(latencies, 0.5), percentile(latencies, 0.9),
+                   percentile(latencies, 0.99))
+    result += '  %5.2f D-Bus calls/event' % (float(calls) / len(stream))
+
+    dcop_log = os.path.join(tmp, 'dcop.log')
+    if os.path.exists(dcop_log):
+        dcop_calls = len(file(dcop_log).readlines())
+        result += '  %5.2f dcop calls/event' % (float(dcop_calls) / len(stream))
+    print result
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--engines', default=','.join(ENGINES),
+                      help='comma separated engines to run [%default]')
+    parser.add_option('--streams', default=','.join(sorted(STREAMS)),
+                      help='comma separated streams to replay [%default]')
+    parser.add_option('--stream-file', action='append', default=[],
+                      help='replay a recorded stream instead')
+    parser.add_option('--coalesce-window', default='0',
+                      help='coalesce_window to run with [%default]')
+    parser.add_option('--min-update-interval', default='0',
+                      help='min_update_interval to run with [%default]')
+    parser.add_option('--sync', action='store_true',
+                      help='run with async_updates off')
+    options, args = parser.parse_args()
+
+    if options.stream_file:
+        streams = [(os.path.basename(path), read_stream(path))
+                   for path in options.stream_file]
+    else:
+        streams = [(name, STREAMS[name]())
+                   for name in options.streams.split(',')]
+
+    tmp = tempfile.mkdtemp(prefix='AmarokPidgin-bench-')
+    out = file(os.path.join(tmp, 'AmarokPidgin.ini'), 'w')
+    out.write(CONFIG % {'coalesce_window': options.coalesce_window,
+                        'min_update_interval': options.min_update_interval,
+                        'async_updates': options.sync and 'false' or 'true'})
+    out.close()
+    out = file(os.path.join(tmp, 'dcop'), 'w')
+    out.write(FAKE_DCOP)
+    out.close()
+    os.chmod(os.path.join(tmp, 'dcop'), 0755)
+
+    env = dict(os.environ)
+    env['PATH'] = tmp + os.pathsep + env.get('PATH', '')
+    env['BENCH_DIR'] = tmp
+
+    daemon, address = start_bus(env)
+    env['DBUS_SESSION_BUS_ADDRESS'] = address
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    fakes = subprocess.Popen([sys.executable,
+                              os.path.join(BENCH_DIR, 'fakes.py')],
+                             stdout=subprocess.PIPE, env=env)
+    try:
+        if fakes.stdout.readline().strip() != 'ready':
+            raise RuntimeError('fake services did not start')
+        obj = dbus.SessionBus().get_object('org.AmarokPidgin.Bench', '/Bench')
+        bench_service = dbus.Interface(obj, 'org.AmarokPidgin.Bench')
+
+        for engine in options.engines.split(','):
+            for name, stream in streams:
+                bench(engine, name, stream, tmp, env, bench_service)
+    finally:
+        os.kill(fakes.pid, signal.SIGTERM)
+        stop(fakes)
+        os.kill(daemon.pid, signal.SIGTERM)
+        stop(daemon)
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,9 @@
 Importer.loadQtBinding("qt.core");
 
-// Start AmarokPidgin.py
+// Start AmarokPidgin.py. It listens to Amarok's MPRIS signals itself.
 params = new Array();
-params[0] = Amarok.Info.scriptPath() + "/MPRISPidgin.py";
-params[1] = Amarok.Info.scriptPath() + "/AmarokPidgin.py";
+params[0] = Amarok.Info.scriptPath() + "/AmarokPidgin.py";
+params[1] = "mpris";
 var amarokpidgin = new QProcess(Amarok);
 amarokpidgin.start("python", params);
 